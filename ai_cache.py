@@ -0,0 +1,61 @@
+# ai_cache.py
+# Persistent on-disk cache for deterministic (temperature=0) OpenAI responses.
+import os
+import json
+import time
+import sqlite3
+import hashlib
+from typing import Optional
+
+from config import USER_DIR, AI_CACHE_FILENAME, AI_CACHE_TTL_SECONDS
+
+# --- Connection ---
+# A single connection is opened lazily and reused for the whole run.
+_conn: Optional[sqlite3.Connection] = None
+
+def _get_connection() -> sqlite3.Connection:
+    """Opens (and creates, if needed) the SQLite cache database."""
+    global _conn
+    if _conn is None:
+        _conn = sqlite3.connect(os.path.join(USER_DIR, AI_CACHE_FILENAME), check_same_thread=False)
+        _conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, value TEXT, created_at INT)"
+        )
+        _conn.commit()
+    return _conn
+
+# --- Public API ---
+
+def cache_key(model: str, prompt: str, temperature: float, json_mode: bool = False, system: Optional[str] = None) -> str:
+    """Builds a stable SHA-256 key from everything that determines the response."""
+    payload = json.dumps({"m": model, "p": prompt, "t": temperature, "j": json_mode, "s": system}, sort_keys=True)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+def get(key: str) -> Optional[str]:
+    """Returns the cached response for `key`, or None if missing or expired."""
+    try:
+        row = _get_connection().execute(
+            "SELECT value, created_at FROM responses WHERE key = ?", (key,)
+        ).fetchone()
+    except sqlite3.Error as e:
+        print(f"  [CACHE AVISO] Falha ao ler o cache de respostas da IA: {e}")
+        return None
+
+    if row is None:
+        return None
+    value, created_at = row
+    if time.time() - created_at > AI_CACHE_TTL_SECONDS:
+        return None
+    return value
+
+def set(key: str, value: str):
+    """Stores (or refreshes) the response for `key`."""
+    try:
+        conn = _get_connection()
+        conn.execute(
+            "INSERT OR REPLACE INTO responses (key, value, created_at) VALUES (?, ?, ?)",
+            (key, value, int(time.time()))
+        )
+        conn.commit()
+    except sqlite3.Error as e:
+        print(f"  [CACHE AVISO] Falha ao gravar no cache de respostas da IA: {e}")
@@ -1,46 +1,177 @@
 # ai_client.py
 # A robust client for interacting with the OpenAI API.
+import asyncio
+import json
+import random
+import re
 import time
-from typing import Optional, Dict, Any
+from typing import Optional, Dict, Any, List, Tuple
 
 import openai
 
-from config import OPENAI_API_KEY, OPENAI_MODEL
+# tiktoken gives exact token counts; without it, prompts are trimmed by characters.
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+import ai_cache
+from config import (OPENAI_API_KEY, OPENAI_MODEL, OPENAI_RPM, OPENAI_TPM, OPENAI_BATCH_POLL_SECONDS,
+                    MAX_NOTA_TOKENS, MAX_NOTA_TOKENS_CNPJ)
+
+# --- Rate Limiting ---
+
+class AsyncRateLimiter:
+    """
+    Token bucket that keeps requests within the account's RPM/TPM quota.
+    Capacity refills continuously; each request pre-deducts one request and
+    its estimated prompt tokens, waiting until enough capacity is available.
+    """
+    def __init__(self, max_requests_per_minute: float, max_tokens_per_minute: float):
+        self.max_requests = float(max_requests_per_minute)
+        self.max_tokens = float(max_tokens_per_minute)
+        self.available_requests = self.max_requests
+        self.available_tokens = self.max_tokens
+        self._last_update = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        elapsed = now - self._last_update
+        self._last_update = now
+        self.available_requests = min(self.max_requests, self.available_requests + self.max_requests * elapsed / 60)
+        self.available_tokens = min(self.max_tokens, self.available_tokens + self.max_tokens * elapsed / 60)
+
+    async def acquire(self, tokens: int):
+        """Waits until one request and `tokens` tokens can be spent, then deducts them."""
+        tokens = min(tokens, self.max_tokens) # A single huge prompt must not block forever
+        # The lock makes waiters queue up in order instead of racing for capacity.
+        async with self._lock:
+            while True:
+                self._refill()
+                if self.available_requests >= 1 and self.available_tokens >= tokens:
+                    self.available_requests -= 1
+                    self.available_tokens -= tokens
+                    return
+                wait_requests = (1 - self.available_requests) * 60 / self.max_requests
+                wait_tokens = (tokens - self.available_tokens) * 60 / self.max_tokens
+                await asyncio.sleep(max(wait_requests, wait_tokens))
+
+def _estimate_tokens(text: str) -> int:
+    """Rough token count (~4 characters per token), good enough for throttling."""
+    return len(text) // 4 + 1
+
+# --- Prompt Truncation ---
+_encoding = None
+_encoding_loaded = False
+
+def _get_encoding():
+    """Returns the tokenizer of OPENAI_MODEL (loaded once), or None if unavailable."""
+    global _encoding, _encoding_loaded
+    if not _encoding_loaded and tiktoken is not None:
+        _encoding_loaded = True
+        try:
+            try:
+                _encoding = tiktoken.encoding_for_model(OPENAI_MODEL)
+            except KeyError:
+                _encoding = tiktoken.get_encoding("o200k_base") # Tokenizer of the current GPT-4.x models
+        except Exception as e:
+            # tiktoken downloads its vocabulary on first use, which fails when offline.
+            print(f"  [AI AVISO] Tokenizador indisponível; o texto será truncado por caracteres: {e}")
+    return _encoding
+
+def _truncate_tokens(texto: str, max_tokens: int) -> str:
+    """Collapses redundant whitespace and trims the text to at most `max_tokens` tokens."""
+    # OCR output is full of repeated spaces and blank lines; single line breaks are kept
+    # because they separate the labelled fields of the invoice.
+    texto = re.sub(r'[ \t\f\v]+', ' ', texto)
+    texto = re.sub(r'\s*\n\s*', '\n', texto).strip()
+    encoding = _get_encoding()
+    if encoding is None:
+        return texto[:max_tokens * 4]
+    ids = encoding.encode(texto)
+    return texto if len(ids) <= max_tokens else encoding.decode(ids[:max_tokens])
+
+# --- Retry Backoff ---
+BACKOFF_CAP_SECONDS = 30
+
+def _retry_after_seconds(error: Exception) -> Optional[float]:
+    """Returns the wait requested by the server (Retry-After headers), if any."""
+    headers = getattr(getattr(error, 'response', None), 'headers', None) or {}
+    try:
+        if headers.get('retry-after-ms'):
+            return float(headers['retry-after-ms']) / 1000
+        if headers.get('retry-after'):
+            return float(headers['retry-after'])
+    except (TypeError, ValueError):
+        pass # e.g. an HTTP-date; fall back to exponential backoff
+    return None
+
+def _backoff_seconds(attempt: int) -> float:
+    """Exponential backoff with jitter, so concurrent tasks don't retry in lockstep."""
+    return min(BACKOFF_CAP_SECONDS, 2 ** attempt) * random.uniform(0.5, 1.5)
 
 # --- Client Initialization ---
 # It's better to initialize the client once and reuse it.
 # The main script will handle the API key check.
-client: Optional[openai.OpenAI] = None
+client: Optional[openai.AsyncOpenAI] = None
+rate_limiter: Optional[AsyncRateLimiter] = None
 
 def initialize_ai_client():
     """Initializes the OpenAI client if the API key is available."""
-    global client
+    global client, rate_limiter
     if OPENAI_API_KEY:
-        client = openai.OpenAI(api_key=OPENAI_API_KEY)
+        client = openai.AsyncOpenAI(api_key=OPENAI_API_KEY)
+        rate_limiter = AsyncRateLimiter(OPENAI_RPM, OPENAI_TPM)
     else:
         print("[AI ERRO] Variável de ambiente OPENAI_API_KEY não foi definida.")
 
-def _call_openai_api(prompt: str, max_retries: int = 3, temperature: float = 0.0) -> Optional[str]:
+def _build_messages(prompt: str, system: Optional[str]) -> List[Dict[str, str]]:
+    """Chat messages for a call; the static system message goes first so it can be prefix-cached."""
+    messages = [{"role": "system", "content": system}] if system else []
+    messages.append({"role": "user", "content": prompt})
+    return messages
+
+async def _call_openai_api(prompt: str, max_retries: int = 3, temperature: float = 0.0, json_mode: bool = False,
+                           system: Optional[str] = None) -> Optional[str]:
     """
     Makes a robust call to the OpenAI ChatCompletion API with retries.
+    Deterministic calls (temperature=0) are served from the on-disk cache when possible.
+    With json_mode, the API guarantees the response is a single valid JSON object.
+    `system` is sent as a separate system message ahead of the prompt.
     """
     if not client:
         return None
 
+    cache_key = None
+    if temperature == 0:
+        cache_key = ai_cache.cache_key(OPENAI_MODEL, prompt, temperature, json_mode, system)
+        cached = ai_cache.get(cache_key)
+        if cached is not None:
+            return cached
+
     for attempt in range(max_retries):
         try:
-            response = client.chat.completions.create(
+            await rate_limiter.acquire(_estimate_tokens(prompt) + _estimate_tokens(system or ""))
+            extra_args = {"response_format": {"type": "json_object"}} if json_mode else {}
+            response = await client.chat.completions.create(
                 model=OPENAI_MODEL,
-                messages=[{"role": "user", "content": prompt}],
-                temperature=temperature
+                messages=_build_messages(prompt, system),
+                temperature=temperature,
+                **extra_args
             )
-            return response.choices[0].message.content.strip()
+            content = response.choices[0].message.content.strip()
+            if cache_key:
+                ai_cache.set(cache_key, content)
+            return content
         except openai.APIConnectionError as e:
             print(f"  [AI AVISO] Falha de conexão com a API OpenAI (tentativa {attempt + 1}/{max_retries}): {e}")
-            time.sleep(2 ** attempt) # Exponential backoff
+            await asyncio.sleep(_backoff_seconds(attempt))
         except openai.RateLimitError as e:
             print(f"  [AI AVISO] Limite de taxa da API excedido (tentativa {attempt + 1}/{max_retries}): {e}")
-            time.sleep(5)
+            # Honor the server's Retry-After when present; jitter still spreads the retries.
+            retry_after = _retry_after_seconds(e) or 2 ** attempt
+            await asyncio.sleep(retry_after * random.uniform(0.8, 1.2))
         except Exception as e:
             print(f"  [AI ERRO] Um erro inesperado ocorreu na chamada da API (tentativa {attempt + 1}/{max_retries}): {e}")
             break # Don't retry on unexpected errors
@@ -48,7 +179,7 @@ def _call_openai_api(prompt: str, max_retries: int = 3, temperature: float = 0.0
 
 # --- Specific AI Functions ---
 
-def ai_extract_taker_cnpj(texto_nota: str) -> Optional[str]:
+async def ai_extract_taker_cnpj(texto_nota: str) -> Optional[str]:
     """Uses AI to find the most likely CNPJ of the service taker."""
     prompt = f"""
     Analise o texto desta Nota Fiscal de Serviço (NFS-e) e extraia APENAS o número do CNPJ do TOMADOR do serviço.
@@ -57,74 +188,388 @@ def ai_extract_taker_cnpj(texto_nota: str) -> Optional[str]:
 
     Texto da Nota:
     ---
-    {texto_nota[:4000]}
+    {_truncate_tokens(texto_nota, MAX_NOTA_TOKENS_CNPJ)}
     ---
     """
-    result = _call_openai_api(prompt)
+    result = await _call_openai_api(prompt)
     return result if result and "NAO_ENCONTRADO" not in result else None
 
-def ai_extract_invoice_data(texto_nota: str) -> Optional[Dict[str, Any]]:
-    """Uses AI to extract the main structured data from the invoice text."""
-    prompt = f"""
-    Você é um assistente de contabilidade especializado em NFS-e do Brasil. Extraia os seguintes dados do texto da nota fiscal abaixo e retorne um dicionário JSON.
+# Fields extracted from every invoice, with the instruction given to the model.
+INVOICE_FIELDS: Dict[str, str] = {
+    "cnpj_prestador": "CNPJ do PRESTADOR do serviço (apenas dígitos).",
+    "data_emissao": 'Data de emissão da nota (formato "dd/mm/aaaa").',
+    "nome_fornecedor": "Nome ou Razão Social do PRESTADOR.",
+    "descricao_servico": "A descrição principal dos serviços prestados.",
+    "codigo_servico_municipal": "O código de tributação municipal, se houver.",
+    "subitem_lc116": 'O subitem da Lei Complementar 116, se explicitamente mencionado (formato "X.XX").',
+    "numero_nf": "O número da nota fiscal.",
+    "valor_total": 'O valor total do serviço (use ponto como separador decimal, sem "R$").',
+    "municipio_prestador": "O município do PRESTADOR.",
+    "municipio_tomador": "O município do TOMADOR.",
+}
 
-    - "cnpj_prestador": CNPJ do PRESTADOR do serviço (apenas dígitos).
-    - "data_emissao": Data de emissão da nota (formato "dd/mm/aaaa").
-    - "nome_fornecedor": Nome ou Razão Social do PRESTADOR.
-    - "descricao_servico": A descrição principal dos serviços prestados.
-    - "codigo_servico_municipal": O código de tributação municipal, se houver.
-    - "subitem_lc116": O subitem da Lei Complementar 116, se explicitamente mencionado (formato "X.XX").
-    - "numero_nf": O número da nota fiscal.
-    - "valor_total": O valor total do serviço (use ponto como separador decimal, sem "R$").
-    - "municipio_prestador": O município do PRESTADOR.
-    - "municipio_tomador": O município do TOMADOR.
+_SIMPLES_NAO_IDENTIFICADO = {"optante_simples": "nao_identificado", "status_simei": "nao_identificado"}
 
-    Se um campo não for encontrado, retorne um valor nulo (null).
+# Field list section of the invoice prompts, in INVOICE_FIELDS order.
+_INVOICE_FIELDS_PROMPT = "\n".join(f'- "{campo}": {instrucao}' for campo, instrucao in INVOICE_FIELDS.items())
 
-    Texto da Nota:
-    ---
-    {texto_nota[:8000]}
-    ---
+# --- Static Prompts ---
+# OpenAI caches prompt prefixes of 1024+ tokens. The instructions, the full field
+# schema and the few-shot examples below are byte-identical on every call and go
+# in the system message; only the invoice (and consultation) text varies, in the
+# user message. Every field is always requested, even when some are already known,
+# so the prefix never changes; known fields are simply not overwritten.
+
+# (nota, invoice, consulta, simples) few-shot examples. The data is fictitious.
+_EXEMPLOS = (
+    (
+        "PREFEITURA MUNICIPAL DE SÃO PAULO\n"
+        "NOTA FISCAL ELETRÔNICA DE SERVIÇOS - NFS-e\n"
+        "Número da Nota: 00004521 Data e Hora de Emissão: 12/03/2024 09:41:17 Código de Verificação: AB12-CD34\n"
+        "PRESTADOR DE SERVIÇOS\n"
+        "CPF/CNPJ: 11.222.333/0001-81 Inscrição Municipal: 4.567.890-1\n"
+        "Nome/Razão Social: LIMPAR BEM SERVIÇOS DE CONSERVAÇÃO LTDA\n"
+        "Endereço: RUA DAS FLORES 120, CENTRO - CEP: 01010-000 Município: São Paulo UF: SP\n"
+        "TOMADOR DE SERVIÇOS\n"
+        "CPF/CNPJ: 44.555.666/0001-99\n"
+        "Nome/Razão Social: HOSPITAL SANTA CLARA S.A.\n"
+        "Endereço: AV. BRASIL 2000 - CEP: 13010-000 Município: Campinas UF: SP\n"
+        "DISCRIMINAÇÃO DOS SERVIÇOS\n"
+        "Serviços de limpeza e conservação predial referentes a fevereiro/2024, conforme contrato 015/2023.\n"
+        "Cessão de mão de obra: 6 colaboradores.\n"
+        "VALOR TOTAL DO SERVIÇO = R$ 18.450,00\n"
+        "Código do Serviço: 07498 - Limpeza, manutenção e conservação de imóveis\n"
+        "Item da Lista de Serviços: 7.10",
+        {
+            "cnpj_prestador": "11222333000181",
+            "data_emissao": "12/03/2024",
+            "nome_fornecedor": "LIMPAR BEM SERVIÇOS DE CONSERVAÇÃO LTDA",
+            "descricao_servico": "Serviços de limpeza e conservação predial referentes a fevereiro/2024, conforme contrato 015/2023.",
+            "codigo_servico_municipal": "07498",
+            "subitem_lc116": "7.10",
+            "numero_nf": "00004521",
+            "valor_total": 18450.00,
+            "municipio_prestador": "São Paulo",
+            "municipio_tomador": "Campinas",
+        },
+        "Consulta Optantes\n"
+        "Data da consulta: 15/03/2024\n"
+        "CNPJ: 11.222.333/0001-81\n"
+        "Nome Empresarial: LIMPAR BEM SERVIÇOS DE CONSERVAÇÃO LTDA\n"
+        "Situação Atual\n"
+        "Situação no Simples Nacional: NÃO optante pelo Simples Nacional\n"
+        "Situação no SIMEI: NÃO enquadrado no SIMEI\n"
+        "Períodos Anteriores\n"
+        "Opções pelo Simples Nacional em Períodos Anteriores: Data Inicial 01/01/2015 Data Final 31/12/2019 Detalhamento: Excluída por Ato Administrativo",
+        {"optante_simples": "nao_optante", "status_simei": "nao_simei"},
+    ),
+    (
+        "NFS-e - NOTA FISCAL DE SERVIÇOS ELETRÔNICA\n"
+        "Prefeitura Municipal de Belo Horizonte - Secretaria Municipal de Fazenda\n"
+        "Nº da NFS-e: 2024/118 Emitida em: 05/06/2024\n"
+        "Prestador: TECNOSUPORTE INFORMÁTICA EIRELI CNPJ 22.333.444/0001-05 Belo Horizonte/MG\n"
+        "Tomador: CLÍNICA VIDA PLENA LTDA CNPJ 55.666.777/0001-30 Contagem/MG\n"
+        "Descrição: Suporte técnico em informática e manutenção de computadores - junho/2024.\n"
+        "Atividade: 01.07 Suporte técnico em informática, inclusive instalação, configuração e manutenção de programas de computação e bancos de dados.\n"
+        "Código de Tributação do Município: 010700188\n"
+        "Valor dos Serviços: R$ 2.300,00 Base de Cálculo: R$ 2.300,00 Alíquota: 2,00% ISSQN: R$ 46,00",
+        {
+            "cnpj_prestador": "22333444000105",
+            "data_emissao": "05/06/2024",
+            "nome_fornecedor": "TECNOSUPORTE INFORMÁTICA EIRELI",
+            "descricao_servico": "Suporte técnico em informática e manutenção de computadores - junho/2024.",
+            "codigo_servico_municipal": "010700188",
+            "subitem_lc116": "1.07",
+            "numero_nf": "2024/118",
+            "valor_total": 2300.00,
+            "municipio_prestador": "Belo Horizonte",
+            "municipio_tomador": "Contagem",
+        },
+        "Consulta Optantes\n"
+        "Data da consulta: 10/06/2024\n"
+        "CNPJ: 22.333.444/0001-05\n"
+        "Nome Empresarial: TECNOSUPORTE INFORMÁTICA EIRELI\n"
+        "Situação Atual\n"
+        "Situação no Simples Nacional: Optante pelo Simples Nacional desde 01/01/2021\n"
+        "Situação no SIMEI: NÃO enquadrado no SIMEI\n"
+        "Períodos Anteriores\n"
+        "Não Existem",
+        {"optante_simples": "optante", "status_simei": "nao_simei"},
+    ),
+    (
+        "NOTA FISCAL DE SERVIÇO ELETRÔNICA (NFS-e) - PADRÃO NACIONAL\n"
+        "Número: 37 Competência: 04/2024 Data de Emissão: 28/04/2024\n"
+        "EMITENTE DA NFS-e\n"
+        "Prestador do Serviço: JOSÉ CARLOS PINTURAS 12345678901 CNPJ: 33.444.555/0001-60 Município: Osasco - SP\n"
+        "TOMADOR DO SERVIÇO\n"
+        "CNPJ: 66.777.888/0001-41 Nome: ASSOCIAÇÃO BENEFICENTE AMIGOS DO BAIRRO Município: Barueri - SP\n"
+        "SERVIÇO PRESTADO\n"
+        "Código de Tributação Nacional: 07.02.01\n"
+        "Descrição do Serviço: Pintura interna das salas de atendimento, com fornecimento de material.\n"
+        "VALOR TOTAL DA NFS-e: R$ 950,00",
+        {
+            "cnpj_prestador": "33444555000160",
+            "data_emissao": "28/04/2024",
+            "nome_fornecedor": "JOSÉ CARLOS PINTURAS 12345678901",
+            "descricao_servico": "Pintura interna das salas de atendimento, com fornecimento de material.",
+            "codigo_servico_municipal": None,
+            "subitem_lc116": "7.02",
+            "numero_nf": "37",
+            "valor_total": 950.00,
+            "municipio_prestador": "Osasco",
+            "municipio_tomador": "Barueri",
+        },
+        "Consulta Optantes\n"
+        "Data da consulta: 02/05/2024\n"
+        "CNPJ: 33.444.555/0001-60\n"
+        "Nome Empresarial: JOSÉ CARLOS PINTURAS 12345678901\n"
+        "Situação Atual\n"
+        "Situação no Simples Nacional: Optante pelo Simples Nacional desde 15/08/2022\n"
+        "Situação no SIMEI: Enquadrado no SIMEI desde 15/08/2022",
+        {"optante_simples": "optante", "status_simei": "simei"},
+    ),
+    (
+        "RECIBO PROVISÓRIO DE SERVIÇOS - RPS convertido em NFS-e\n"
+        "Município de Curitiba - PR\n"
+        "NFS-e nº 9087 emitida em 19/07/2024 às 16:05\n"
+        "Prestador: VIGILÂNCIA ALERTA LTDA - CNPJ 77.888.999/0001-12 - Curitiba/PR\n"
+        "Tomador: CNPJ 88.999.000/0001-23 - FUNDAÇÃO APOIO À SAÚDE\n"
+        "Discriminação: Serviços de vigilância patrimonial desarmada, posto 12x36, julho/2024.\n"
+        "Valor Bruto: R$ 31.780,45 Deduções: R$ 0,00\n"
+        "Retenções: INSS R$ 3.495,85 IRRF R$ 317,80 PIS/COFINS/CSLL R$ 1.477,79",
+        {
+            "cnpj_prestador": "77888999000112",
+            "data_emissao": "19/07/2024",
+            "nome_fornecedor": "VIGILÂNCIA ALERTA LTDA",
+            "descricao_servico": "Serviços de vigilância patrimonial desarmada, posto 12x36, julho/2024.",
+            "codigo_servico_municipal": None,
+            "subitem_lc116": None,
+            "numero_nf": "9087",
+            "valor_total": 31780.45,
+            "municipio_prestador": "Curitiba",
+            "municipio_tomador": None,
+        },
+        None,
+        dict(_SIMPLES_NAO_IDENTIFICADO),
+    ),
+)
+
+def _user_message(texto_nota: str, consulta_texto: Optional[str] = None, com_consulta: bool = False) -> str:
+    """Builds the variable part of an invoice prompt (the user message)."""
+    mensagem = f"Texto da Nota:\n---\n{texto_nota}\n---"
+    if com_consulta:
+        mensagem += f"\n\nTexto da Consulta:\n---\n{consulta_texto or 'CONSULTA INDISPONÍVEL'}\n---"
+    return mensagem
+
+def _exemplos_prompt(com_consulta: bool) -> str:
+    """Renders the few-shot examples in the same format as the real user messages and answers."""
+    blocos = []
+    for i, (nota, invoice, consulta, simples) in enumerate(_EXEMPLOS, start=1):
+        resposta = {"invoice": invoice, "simples": simples} if com_consulta else invoice
+        blocos.append(f"Exemplo {i}:\n{_user_message(nota, consulta, com_consulta)}\n"
+                      f"Resposta:\n{json.dumps(resposta, ensure_ascii=False)}")
+    return "\n\n".join(blocos)
+
+_INVOICE_SYSTEM_PROMPT = f"""Você é um assistente de contabilidade especializado em NFS-e do Brasil. Extraia do texto da nota fiscal enviado pelo usuário um JSON com:
+
+{_INVOICE_FIELDS_PROMPT}
+
+Se um campo não for encontrado, retorne um valor nulo (null).
+O PRESTADOR é quem emite a nota e presta o serviço; o TOMADOR é quem o contrata. Não confunda os dois.
+Não invente valores: o subitem da LC 116 só deve ser preenchido se aparecer no texto.
+
+{_exemplos_prompt(False)}"""
+
+_INVOICE_AND_SIMPLES_SYSTEM_PROMPT = f"""Você é um assistente de contabilidade especializado em NFS-e do Brasil. O usuário envia duas seções: o texto de uma nota fiscal e o texto da consulta do Simples Nacional do PRESTADOR.
+Responda com um JSON no formato {{"invoice": {{...}}, "simples": {{...}}}}.
+
+Em "invoice", extraia da nota:
+
+{_INVOICE_FIELDS_PROMPT}
+
+Se um campo não for encontrado, retorne um valor nulo (null).
+O PRESTADOR é quem emite a nota e presta o serviço; o TOMADOR é quem o contrata. Não confunda os dois.
+Não invente valores: o subitem da LC 116 só deve ser preenchido se aparecer no texto.
+
+Em "simples", usando a data de emissão da nota como data de referência, determine:
+- "optante_simples": A empresa era optante pelo Simples Nacional? APENAS "optante", "nao_optante" ou "nao_identificado".
+- "status_simei": A empresa era optante pelo SIMEI (MEI)? APENAS "simei", "nao_simei" ou "nao_identificado".
+Se a consulta estiver ausente ou inconclusiva, use "nao_identificado".
+
+{_exemplos_prompt(True)}"""
+
+def _resolve_known_fields(conhecidos: Optional[Dict[str, Any]]) -> Tuple[Dict[str, Any], List[str]]:
+    """
+    Returns (dados, campos_faltantes): a copy of the fields already resolved by the caller and the ones left for the AI.
+    The heuristics never resolve the descriptive fields (service, names, cities), so the AI call is always needed.
     """
-    # A more advanced version might ask for a JSON response directly.
-    # For simplicity, we'll parse a formatted string for now.
-    import json
-    result_str = _call_openai_api(prompt, temperature=0.0)
+    dados = dict(conhecidos or {})
+    return dados, [campo for campo in INVOICE_FIELDS if campo not in dados]
+
+async def ai_extract_invoice_data(texto_nota: str, conhecidos: Optional[Dict[str, Any]] = None) -> Optional[Dict[str, Any]]:
+    """
+    Uses AI to extract the main structured data from the invoice text.
+    Fields in `conhecidos` (already resolved elsewhere) are never overwritten by the AI.
+    """
+    dados, campos = _resolve_known_fields(conhecidos)
+    prompt = _user_message(_truncate_tokens(texto_nota, MAX_NOTA_TOKENS))
+    result_str = await _call_openai_api(prompt, temperature=0.0, json_mode=True, system=_INVOICE_SYSTEM_PROMPT)
 
     if not result_str:
         return None
 
     try:
-        # The AI might return the JSON inside a code block, so we clean it up.
-        clean_json_str = result_str.strip().replace("```json", "").replace("```", "").strip()
-        return json.loads(clean_json_str)
+        extraidos = json.loads(result_str)
     except json.JSONDecodeError:
         print(f"  [AI ERRO] Não foi possível decodificar a resposta JSON da IA: {result_str}")
         return None
 
-def ai_analyze_simples_status(consulta_texto: str, data_emissao: str) -> Dict[str, Any]:
+    dados.update({campo: extraidos.get(campo) for campo in campos})
+    return dados
+
+async def ai_analyze_simples_status(consulta_texto: str, data_emissao: str) -> Dict[str, Any]:
     """Uses AI to determine Simples and SIMEI status from the consultation text."""
     prompt = f"""
     Analise o texto da consulta do Simples Nacional abaixo. Para a data de referência {data_emissao}, determine duas coisas:
     1. A empresa era optante pelo Simples Nacional? Responda APENAS: "optante", "nao_optante", ou "nao_identificado".
     2. A empresa era optante pelo SIMEI (MEI)? Responda APENAS: "simei", "nao_simei", ou "nao_identificado".
 
-    Combine as duas respostas em um JSON. Exemplo: {{"optante_simples": "optante", "status_simei": "nao_simei"}}
+    Responda em JSON. Exemplo: {{"optante_simples": "optante", "status_simei": "nao_simei"}}
 
     Texto da Consulta:
     ---
     {consulta_texto}
     ---
     """
-    import json
-    result_str = _call_openai_api(prompt, temperature=0.0)
+    result_str = await _call_openai_api(prompt, temperature=0.0, json_mode=True)
 
     if not result_str:
-        return {"optante_simples": "nao_identificado", "status_simei": "nao_identificado"}
+        return dict(_SIMPLES_NAO_IDENTIFICADO)
 
     try:
-        clean_json_str = result_str.strip().replace("```json", "").replace("```", "").strip()
-        return json.loads(clean_json_str)
+        return json.loads(result_str)
     except json.JSONDecodeError:
         print(f"  [AI ERRO] Não foi possível decodificar a resposta JSON da análise do Simples: {result_str}")
-        return {"optante_simples": "nao_identificado", "status_simei": "nao_identificado"}
+        return dict(_SIMPLES_NAO_IDENTIFICADO)
+
+def _build_invoice_and_simples_prompt(texto_nota: str, consulta_texto: Optional[str]) -> str:
+    """User message of the combined call; the instructions are in _INVOICE_AND_SIMPLES_SYSTEM_PROMPT."""
+    return _user_message(_truncate_tokens(texto_nota, MAX_NOTA_TOKENS), consulta_texto, com_consulta=True)
+
+def _parse_invoice_and_simples(result_str: Optional[str], dados: Dict[str, Any], campos: List[str]) -> Optional[Dict[str, Any]]:
+    """Merges the AI answer for `campos` into `dados`. Returns {"invoice", "simples"} or None."""
+    if not result_str:
+        return None
+
+    try:
+        resultado = json.loads(result_str)
+    except json.JSONDecodeError:
+        print(f"  [AI ERRO] Não foi possível decodificar a resposta JSON da IA: {result_str}")
+        return None
+
+    if not isinstance(resultado.get('invoice'), dict):
+        print(f"  [AI ERRO] Resposta da IA sem os dados da nota: {result_str}")
+        return None
+    if not isinstance(resultado.get('simples'), dict):
+        resultado['simples'] = dict(_SIMPLES_NAO_IDENTIFICADO)
+
+    dados.update({campo: resultado['invoice'].get(campo) for campo in campos})
+    return {"invoice": dados, "simples": resultado['simples']}
+
+async def ai_extract_invoice_and_simples(texto_nota: str, consulta_texto: Optional[str],
+                                         conhecidos: Optional[Dict[str, Any]] = None) -> Optional[Dict[str, Any]]:
+    """
+    Extracts the invoice data AND analyzes the Simples consultation in a single call.
+    Fields in `conhecidos` (already resolved elsewhere) are never overwritten by the AI.
+    Returns {"invoice": {...}, "simples": {...}}, or None if the extraction fails.
+    """
+    dados, campos = _resolve_known_fields(conhecidos)
+    prompt = _build_invoice_and_simples_prompt(texto_nota, consulta_texto)
+    result_str = await _call_openai_api(prompt, temperature=0.0, json_mode=True, system=_INVOICE_AND_SIMPLES_SYSTEM_PROMPT)
+    return _parse_invoice_and_simples(result_str, dados, campos)
+
+# --- Batch API ---
+# Non-interactive runs can trade latency for cost: the Batch API is ~50% cheaper
+# and has its own rate-limit pool, but results may take up to 24h.
+
+async def _run_chat_batch(prompts: Dict[str, str], system: Optional[str] = None,
+                          temperature: float = 0.0) -> Dict[str, Optional[str]]:
+    """
+    Submits one JSON-mode chat completion per prompt (sharing the `system` message) through the Batch API,
+    waits for it to finish and returns the response content per custom_id.
+    Prompts with a cached response are not resubmitted.
+    """
+    results: Dict[str, Optional[str]] = {}
+    cache_keys = {}
+    lines = []
+    for custom_id, prompt in prompts.items():
+        cache_keys[custom_id] = ai_cache.cache_key(OPENAI_MODEL, prompt, temperature, True, system)
+        cached = ai_cache.get(cache_keys[custom_id])
+        if cached is not None:
+            results[custom_id] = cached
+            continue
+        lines.append(json.dumps({
+            "custom_id": custom_id,
+            "method": "POST",
+            "url": "/v1/chat/completions",
+            "body": {
+                "model": OPENAI_MODEL,
+                "messages": _build_messages(prompt, system),
+                "temperature": temperature,
+                "response_format": {"type": "json_object"},
+            },
+        }, ensure_ascii=False))
+
+    if not lines or not client:
+        return results
+
+    try:
+        batch_file = await client.files.create(file=("mapa_batch.jsonl", "\n".join(lines).encode('utf-8')), purpose="batch")
+        batch = await client.batches.create(input_file_id=batch_file.id, endpoint="/v1/chat/completions", completion_window="24h")
+        print(f"  [AI] Lote {batch.id} enviado com {len(lines)} requisição(ões). Aguardando conclusão...")
+
+        while batch.status not in ("completed", "failed", "expired", "cancelled"):
+            await asyncio.sleep(OPENAI_BATCH_POLL_SECONDS)
+            batch = await client.batches.retrieve(batch.id)
+            counts = batch.request_counts
+            if counts:
+                print(f"  [AI] Lote {batch.id}: {batch.status} ({counts.completed}/{counts.total} concluídas)")
+
+        if not batch.output_file_id:
+            print(f"  [AI ERRO] Lote {batch.id} terminou sem resultados (status: {batch.status}).")
+            return results
+
+        output = await client.files.content(batch.output_file_id)
+        for line in output.text.splitlines():
+            if not line.strip():
+                continue
+            item = json.loads(line)
+            response = item.get('response') or {}
+            if response.get('status_code') != 200:
+                print(f"  [AI ERRO] Requisição '{item.get('custom_id')}' falhou no lote: {item.get('error') or response}")
+                continue
+            content = response['body']['choices'][0]['message']['content'].strip()
+            results[item['custom_id']] = content
+            ai_cache.set(cache_keys[item['custom_id']], content)
+    except Exception as e:
+        print(f"  [AI ERRO] Falha ao processar o lote na Batch API: {e}")
+    return results
+
+async def ai_extract_invoice_and_simples_batch(itens: Dict[str, Tuple[str, Optional[str], Optional[Dict[str, Any]]]]) -> Dict[str, Optional[Dict[str, Any]]]:
+    """
+    Batch API version of ai_extract_invoice_and_simples.
+    `itens` maps an id (e.g. the filename) to (texto_nota, consulta_texto, conhecidos).
+    Returns the same structure as the single-call version for each id (None on failure).
+    """
+    resultados: Dict[str, Optional[Dict[str, Any]]] = {}
+    pendentes = {}
+    prompts = {}
+    for custom_id, (texto_nota, consulta_texto, conhecidos) in itens.items():
+        dados, campos = _resolve_known_fields(conhecidos)
+        pendentes[custom_id] = (dados, campos)
+        prompts[custom_id] = _build_invoice_and_simples_prompt(texto_nota, consulta_texto)
+
+    respostas = await _run_chat_batch(prompts, _INVOICE_AND_SIMPLES_SYSTEM_PROMPT)
+    for custom_id, (dados, campos) in pendentes.items():
+        resultados[custom_id] = _parse_invoice_and_simples(respostas.get(custom_id), dados, campos)
+    return resultados
@@ -25,6 +25,37 @@ CAMINHO_REDE = r"\\192.168.200.2\update"
 # The user must set the OPENAI_API_KEY environment variable.
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 OPENAI_MODEL = os.getenv("OPENAI_MODEL", "gpt-4.1-mini")
+# Account quota (requests and tokens per minute) enforced on the client side.
+OPENAI_RPM = int(os.getenv("OPENAI_RPM", "500"))
+OPENAI_TPM = int(os.getenv("OPENAI_TPM", "200000"))
+# Token budget for the invoice text sent in each prompt (the CNPJ-only prompt needs less).
+MAX_NOTA_TOKENS = 2000
+MAX_NOTA_TOKENS_CNPJ = 1000
+# How often a submitted Batch API job is polled for completion.
+OPENAI_BATCH_POLL_SECONDS = 30
+
+# --- AI Response Cache ---
+# Deterministic (temperature=0) responses are cached on disk under USER_DIR.
+AI_CACHE_FILENAME = "ai_cache.sqlite3"
+AI_CACHE_TTL_SECONDS = int(os.getenv("AI_CACHE_TTL_SECONDS", str(30 * 24 * 3600))) # 30 days
+
+# --- Concurrency Configuration ---
+# Maximum number of invoices processed at the same time. Each one holds at
+# most one in-flight OpenAI request, so this also caps open connections.
+MAX_CONCURRENT_FILES = int(os.getenv("MAX_CONCURRENT_FILES", "10"))
+
+# --- Simples Nacional Consultation ---
+# The site is queried over HTTP first; when that fails (e.g. CAPTCHA), the
+# pyautogui browser automation can be used as a fallback.
+SIMPLES_HTTP_TIMEOUT_SECONDS = 15
+# Parallel HTTP consultations in batch runs (keep it low: the site is rate limited).
+SIMPLES_HTTP_MAX_WORKERS = int(os.getenv("SIMPLES_HTTP_MAX_WORKERS", "8"))
+SIMPLES_AUTOMACAO_FALLBACK = os.getenv("SIMPLES_AUTOMACAO_FALLBACK", "1") == "1"
+# Screenshots (in APP_DIR) of an element only visible once each page is ready.
+# The automation polls the screen for them; without the images it waits the full timeout.
+SIMPLES_FORM_MARKER_IMAGE = "simples_form_marker.png"
+SIMPLES_RESULT_MARKER_IMAGE = "simples_result_marker.png"
+SIMPLES_MARKER_CONFIDENCE = 0.85 # Requires opencv-python; exact matching otherwise
 
 # --- Tesseract Configuration ---
 # These paths are standard for Windows installations.
@@ -40,6 +71,7 @@ CNAE_FILENAME = "cnae.xlsx"
 REINF_FILENAME = "reinf.xlsx"
 SERVICOS_LC116_FILENAME = "servicos_lei_complementar.txt"
 DECISOES_CACHE_FILENAME = "decisoes_cnae_lc116.json"
+RULES_CACHE_FILENAME = "rules.cache.pkl"
 
 # --- Fiscal Rules Configuration ---
 # List of service codes that are exceptions for non-Simples companies.
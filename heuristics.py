@@ -0,0 +1,93 @@
+# heuristics.py
+# Deterministic (regex-based) extraction of invoice fields that do not need AI.
+import re
+from typing import List, Optional, Dict, Any, Tuple
+
+# --- Patterns ---
+# CNPJ, formatted ("12.345.678/0001-90") or as 14 plain digits.
+CNPJ_RE = re.compile(r'(?<!\d)(\d{2}\.?\d{3}\.?\d{3}/?\d{4}-?\d{2})(?!\d)')
+# The remaining patterns only match when the field is explicitly labelled,
+# so an unlabelled date or amount is never mistaken for the wrong field.
+# The RPS (provisional receipt) has its own emission date, which is not the invoice's.
+DATA_EMISSAO_RE = re.compile(r'Data\s+(?:e\s+Hora\s+)?(?:da\s+|de\s+)?Emiss[ãa]o(?!\s*(?:d[oa]\s+)?RPS)\D{0,20}?(\d{2}/\d{2}/\d{4})',
+                             re.IGNORECASE)
+# The whole number token: municipalities use formats like "2024/118" or "123-A".
+NUMERO_NF_RE = re.compile(r'N[úu]mero\s+da\s+(?:NFS-?e|Nota)\D{0,10}?(\d(?:[\w./-]*\w)?)', re.IGNORECASE)
+VALOR_TOTAL_RE = re.compile(r'Valor\s+(?:Total\s+)?(?:d[oa]s?\s+)?(?:Servi[çc]os?|Nota)\s*:?\s*R\$\s*(\d{1,3}(?:\.\d{3})*,\d{2})', re.IGNORECASE)
+# Section labels: the prestador block runs from its label up to the tomador label.
+PRESTADOR_LABEL_RE = re.compile(r'\b(?:Prestador|Emitente)\b', re.IGNORECASE)
+TOMADOR_LABEL_RE = re.compile(r'\b(?:Tomador|Destinat[áa]rio)\b', re.IGNORECASE)
+SUBITEM_LC116_RE = re.compile(r'(?:Item|Subitem)\s+da\s+Lista\s+de\s+Servi[çc]os?\D{0,20}?(\d{1,2}\.\d{2})\b', re.IGNORECASE)
+
+def somente_digitos(texto: Optional[str]) -> str:
+    """Removes every non-digit character (e.g. CNPJ formatting)."""
+    return re.sub(r'\D', '', texto or '')
+
+def extrair_cnpjs(texto: str) -> List[str]:
+    """Returns every distinct CNPJ in the text (digits only), in order of appearance."""
+    cnpjs = []
+    for match in CNPJ_RE.finditer(texto):
+        cnpj = somente_digitos(match.group(1))
+        if cnpj not in cnpjs:
+            cnpjs.append(cnpj)
+    return cnpjs
+
+def _cnpj_bloco_prestador(texto: str) -> Tuple[bool, Optional[str]]:
+    """
+    Returns (has_prestador_label, cnpj): the first CNPJ between the prestador/emitente
+    label and the next tomador label. A prestador identified by CPF has no CNPJ there.
+    """
+    label = PRESTADOR_LABEL_RE.search(texto)
+    if not label:
+        return False, None
+    fim = TOMADOR_LABEL_RE.search(texto, label.end())
+    match = CNPJ_RE.search(texto, label.end(), fim.start() if fim else len(texto))
+    return True, somente_digitos(match.group(1)) if match else None
+
+def extrair_cnpj_prestador(texto: str) -> Optional[str]:
+    """
+    Returns the most likely CNPJ of the PRESTADOR (digits only), or None.
+    The CNPJ of the labelled prestador block wins; without labels, NFS-e layouts
+    list the prestador before the tomador, so the first CNPJ is taken.
+    Callers must cross-check it: an unlabelled guess may be the tomador's.
+    """
+    rotulado, cnpj = _cnpj_bloco_prestador(texto)
+    if rotulado:
+        return cnpj
+    cnpjs = extrair_cnpjs(texto)
+    return cnpjs[0] if cnpjs else None
+
+def _valor_para_float(valor: str) -> float:
+    """Converts a Brazilian amount ("1.234,56") to float (1234.56)."""
+    return float(valor.replace('.', '').replace(',', '.'))
+
+def heuristic_extract(texto: str) -> Dict[str, Any]:
+    """
+    Extracts the invoice fields that are unambiguous in the text.
+    Only resolved fields are returned; everything else is left to the AI.
+    """
+    dados = {}
+
+    # Only a CNPJ inside the labelled prestador block is certain: a lone CNPJ may be
+    # the tomador's when the prestador is a person identified by CPF.
+    _, cnpj = _cnpj_bloco_prestador(texto)
+    if cnpj:
+        dados['cnpj_prestador'] = cnpj
+
+    match = DATA_EMISSAO_RE.search(texto)
+    if match:
+        dados['data_emissao'] = match.group(1)
+
+    match = NUMERO_NF_RE.search(texto)
+    if match:
+        dados['numero_nf'] = match.group(1)
+
+    match = VALOR_TOTAL_RE.search(texto)
+    if match:
+        dados['valor_total'] = _valor_para_float(match.group(1))
+
+    match = SUBITEM_LC116_RE.search(texto)
+    if match:
+        dados['subitem_lc116'] = match.group(1)
+
+    return dados
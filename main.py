@@ -1,8 +1,15 @@
 # main.py
 # The main orchestrator for the NFS-e processing application.
+import asyncio
+import dataclasses
+import itertools
+import multiprocessing
 import os
+import re
 import sys
-from typing import Dict, Any, List
+from typing import Dict, Any, List, Optional, Tuple, Iterable, Iterator
+
+import pandas as pd
 
 # --- Module Imports ---
 import config
@@ -10,10 +17,25 @@ import ui
 import assets
 import utils
 import pdf_processor
+import heuristics
 import ai_client
 import simples_automator
 import rules_engine
 import mapa_generator
+from models import UserConfig, SimplesStatus, MapaRow
+
+def iter_pdfs(folder: str) -> Iterator[str]:
+    """
+    Lazily yields the names of the invoice PDFs in `folder` (generated MAPAs are skipped).
+    Each invoice is moved out of the folder only after it has been yielded, which
+    does not disturb the remaining entries of the directory scan.
+    """
+    with os.scandir(folder) as it:
+        for entry in it:
+            name = entry.name.lower()
+            # Simple filter to avoid processing already generated MAPAs
+            if name.endswith('.pdf') and 'mapa' not in name and entry.is_file():
+                yield entry.name
 
 def _setup_output_folders(base_path: str) -> Dict[str, str]:
     """Creates the required output folder structure and returns a dict of paths."""
@@ -29,6 +51,268 @@ def _setup_output_folders(base_path: str) -> Dict[str, str]:
     print("-> Estrutura de pastas pronta.")
     return folders
 
+async def _consultar_simples_automacao(cnpj: str, automacao_lock: asyncio.Lock) -> Optional[str]:
+    """Runs the browser automation fallback (if enabled) in a worker thread."""
+    if not config.SIMPLES_AUTOMACAO_FALLBACK:
+        return None
+    # The automation drives the user's mouse and keyboard, so only one query may run at a time.
+    async with automacao_lock:
+        return await asyncio.to_thread(simples_automator.consultar_simples_via_automacao, cnpj)
+
+async def _consultar_simples(cnpj: str, automacao_lock: asyncio.Lock) -> Optional[str]:
+    """Runs the Simples consultation over HTTP, falling back to the browser automation, in a worker thread."""
+    consulta_texto = await asyncio.to_thread(simples_automator.consultar_simples_via_http, cnpj)
+    if consulta_texto is not None:
+        return consulta_texto
+    return await _consultar_simples_automacao(cnpj, automacao_lock)
+
+async def _extrair_dados_nota(texto_nota: str, automacao_lock: asyncio.Lock) -> Tuple[Optional[Dict[str, Any]], Dict[str, Any]]:
+    """
+    Extracts the invoice data and the raw Simples analysis.
+    Fields that regexes resolve unambiguously are never sent to the AI. When the
+    prestador CNPJ can be found by regex, the Simples site is consulted first and
+    a single AI call handles both the remaining fields and the consultation.
+    """
+    conhecidos = heuristics.heuristic_extract(texto_nota)
+    if conhecidos:
+        print(f"  [HEURÍSTICA] Campos resolvidos sem IA: {', '.join(conhecidos)}")
+
+    cnpj_regex = heuristics.extrair_cnpj_prestador(texto_nota)
+    dados_nf = None
+    if cnpj_regex:
+        consulta_texto = await _consultar_simples(cnpj_regex, automacao_lock)
+        resultado = await ai_client.ai_extract_invoice_and_simples(texto_nota, consulta_texto, conhecidos)
+        if resultado:
+            dados_nf = resultado['invoice']
+            if heuristics.somente_digitos(dados_nf.get('cnpj_prestador')) == cnpj_regex:
+                return dados_nf, resultado['simples']
+            print("  [AVISO] CNPJ do prestador identificado pela IA difere do encontrado no texto. Refazendo consulta do Simples.")
+
+    # Fallback: extract first, then consult the Simples with the AI-provided CNPJ.
+    if dados_nf is None:
+        dados_nf = await ai_client.ai_extract_invoice_data(texto_nota, conhecidos)
+    if not dados_nf or not dados_nf.get('cnpj_prestador'):
+        return None, {}
+    # The AI's CNPJ must be one printed on the invoice; anything else is a misreading.
+    if heuristics.somente_digitos(dados_nf['cnpj_prestador']) not in heuristics.extrair_cnpjs(texto_nota):
+        print("  [AVISO] CNPJ do prestador identificado pela IA não consta no texto da nota.")
+        return None, {}
+    consulta_texto = await _consultar_simples(dados_nf['cnpj_prestador'], automacao_lock)
+    simples_status_raw = await ai_client.ai_analyze_simples_status(consulta_texto, dados_nf['data_emissao'])
+    return dados_nf, simples_status_raw
+
+def _mover_para_manual(filename: str, source_folder: str, output_folders: Dict[str, str], erro: Exception):
+    """Reports a processing failure and moves the invoice to the manual review folder."""
+    print(f"  [ERRO NO PROCESSAMENTO] Falha ao processar '{filename}': {erro}")
+    manual_path = os.path.join(output_folders['manual'], filename)
+    try:
+        os.rename(os.path.join(source_folder, filename), manual_path)
+        print(f"-> Arquivo movido para revisão manual: {output_folders['manual']}")
+    except Exception as move_error:
+        print(f"  [ERRO CRÍTICO] Não foi possível mover o arquivo de erro '{filename}': {move_error}")
+
+def _preparar_para_regras(dados_nf: Optional[Dict[str, Any]]):
+    """Checks the essential fields and adds the normalized municipalities used by the rules engine."""
+    if not dados_nf or not dados_nf.get('cnpj_prestador'):
+        raise ValueError("IA falhou ao extrair dados essenciais da nota.")
+
+    # Normalized once here, so the rules engine compares municipalities without per-invoice string work.
+    dados_nf['municipio_prestador_norm'] = utils.normalize_city(dados_nf.get('municipio_prestador'))
+    dados_nf['municipio_tomador_norm'] = utils.normalize_city(dados_nf.get('municipio_tomador'))
+
+def _gerar_mapa(filename: str, source_folder: str, mapa_row: MapaRow, user_config: UserConfig,
+                output_folders: Dict[str, str], relatorio_final: List[MapaRow]):
+    """Generates the MAPA PDF of an invoice that passed the rules engine and moves the processed invoice."""
+    # Add final details to the MAPA row
+    mapa_row.titulo_mapa = f"{user_config.nome_unidade} - {mapa_row.nome_fornecedor}"
+    if user_config.preencher_chamado:
+        match = re.search(r'\d+', filename)
+        mapa_row.numero_chamado = match.group(0) if match else ''
+
+    # Generate MAPA PDF
+    output_pdf_path = os.path.join(output_folders['mapas_pdf'], f"{os.path.splitext(filename)[0]}_MAPA.pdf")
+    mapa_generator.gerar_mapa_pdf(mapa_row, output_pdf_path)
+
+    # Move processed original file
+    final_nota_path = os.path.join(output_folders['notas_geradas'], filename)
+    os.rename(os.path.join(source_folder, filename), final_nota_path)
+    print(f"-> Sucesso! Nota movida para: {output_folders['notas_geradas']}")
+    relatorio_final.append(mapa_row)
+
+def _finalizar_nota(filename: str, source_folder: str, dados_nf: Optional[Dict[str, Any]], simples_status_raw: Dict[str, Any],
+                    texto_nota: str, user_config: UserConfig, rules: Dict[str, Any],
+                    output_folders: Dict[str, str], relatorio_final: List[MapaRow]):
+    """Applies the fiscal rules, generates the MAPA PDF and moves the processed invoice."""
+    _preparar_para_regras(dados_nf)
+    simples_status = SimplesStatus.from_analise(simples_status_raw)
+
+    mapa_row = rules_engine.processar_regras_fiscais(dados_nf, simples_status, user_config, rules, texto_nota)
+
+    if mapa_row is None:
+        # This means the rules engine decided the file should go to manual review.
+        raise ValueError("Nota não passou na triagem do motor de regras.")
+
+    _gerar_mapa(filename, source_folder, mapa_row, user_config, output_folders, relatorio_final)
+
+async def _extrair_texto(filename: str, source_folder: str) -> str:
+    """Extracts the invoice text. OCR is CPU-bound, so it runs in a worker thread to keep the event loop free."""
+    texto_nota = await asyncio.to_thread(pdf_processor.extrair_texto_inteligente, os.path.join(source_folder, filename))
+    if not texto_nota:
+        raise ValueError("Extração de texto resultou em conteúdo insuficiente.")
+    return texto_nota
+
+async def _processar_arquivo(filename: str, source_folder: str, user_config: UserConfig, rules: Dict[str, Any],
+                             output_folders: Dict[str, str], relatorio_final: List[MapaRow],
+                             automacao_lock: asyncio.Lock):
+    """Runs the full pipeline (text, AI, Simples, rules, PDF) for a single invoice."""
+    print(f"\n--- Processando Arquivo: {filename} ---")
+
+    try:
+        texto_nota = await _extrair_texto(filename, source_folder)
+        dados_nf, simples_status_raw = await _extrair_dados_nota(texto_nota, automacao_lock)
+        _finalizar_nota(filename, source_folder, dados_nf, simples_status_raw, texto_nota,
+                        user_config, rules, output_folders, relatorio_final)
+    except Exception as e:
+        _mover_para_manual(filename, source_folder, output_folders, e)
+
+async def _processar_lote(pdf_files: Iterable[str], source_folder: str, user_config: UserConfig, rules: Dict[str, Any],
+                          output_folders: Dict[str, str], relatorio_final: List[MapaRow]):
+    """
+    Processes all invoices with config.MAX_CONCURRENT_FILES workers.
+    The file names are streamed through a bounded queue, so the first invoice
+    starts while the folder is still being listed.
+    """
+    automacao_lock = asyncio.Lock()
+    fila: asyncio.Queue = asyncio.Queue(maxsize=config.MAX_CONCURRENT_FILES * 2)
+    arquivos = iter(pdf_files)
+
+    async def produtor():
+        # Directory listing is blocking I/O (slow on network shares), so it runs off the event loop.
+        while (filename := await asyncio.to_thread(next, arquivos, None)) is not None:
+            await fila.put(filename)
+        for _ in range(config.MAX_CONCURRENT_FILES):
+            await fila.put(None)
+
+    async def trabalhador():
+        while (filename := await fila.get()) is not None:
+            await _processar_arquivo(filename, source_folder, user_config, rules, output_folders, relatorio_final,
+                                     automacao_lock)
+
+    await asyncio.gather(produtor(), *[trabalhador() for _ in range(config.MAX_CONCURRENT_FILES)])
+
+async def _processar_lote_batch(pdf_files: Iterable[str], source_folder: str, user_config: UserConfig, rules: Dict[str, Any],
+                                output_folders: Dict[str, str], relatorio_final: List[MapaRow]):
+    """
+    Batch API variant of _processar_lote for non-interactive runs.
+    Text extraction runs first for every invoice, then the Simples site is queried
+    for all prestadores at once, then all AI extractions are sent as a single OpenAI batch. Invoices that cannot
+    use the batch (no CNPJ found by regex, failed batch item) fall back to the
+    regular per-invoice extraction. The fiscal rules then run once for all extracted
+    invoices, before the MAPAs are generated.
+    """
+    sem = asyncio.Semaphore(config.MAX_CONCURRENT_FILES)
+    automacao_lock = asyncio.Lock()
+    preparadas: Dict[str, Tuple[str, Optional[str], Dict[str, Any]]] = {}
+    extraidas: Dict[str, Tuple[Dict[str, Any], SimplesStatus, str]] = {}
+
+    async def preparar(filename: str):
+        async with sem:
+            print(f"\n--- Preparando Arquivo: {filename} ---")
+            try:
+                texto_nota = await _extrair_texto(filename, source_folder)
+                cnpj_regex = heuristics.extrair_cnpj_prestador(texto_nota)
+                preparadas[filename] = (texto_nota, cnpj_regex, heuristics.heuristic_extract(texto_nota))
+            except Exception as e:
+                _mover_para_manual(filename, source_folder, output_folders, e)
+
+    async def concluir(filename: str, resultado: Optional[Dict[str, Any]]):
+        texto_nota, cnpj_regex, _ = preparadas[filename]
+        async with sem:
+            print(f"\n--- Concluindo Extração: {filename} ---")
+            try:
+                if resultado and heuristics.somente_digitos(resultado['invoice'].get('cnpj_prestador')) == cnpj_regex:
+                    dados_nf, simples_status_raw = resultado['invoice'], resultado['simples']
+                else:
+                    dados_nf, simples_status_raw = await _extrair_dados_nota(texto_nota, automacao_lock)
+                _preparar_para_regras(dados_nf)
+                extraidas[filename] = (dados_nf, SimplesStatus.from_analise(simples_status_raw), texto_nota)
+            except Exception as e:
+                _mover_para_manual(filename, source_folder, output_folders, e)
+
+    await asyncio.gather(*[preparar(filename) for filename in pdf_files])
+
+    # Each prestador is consulted once, in parallel over HTTP; failures go through the automation one by one.
+    cnpjs = [cnpj_regex for _, cnpj_regex, _ in preparadas.values() if cnpj_regex]
+    consultas = await asyncio.to_thread(simples_automator.consultar_simples_batch, cnpjs)
+    for cnpj, consulta_texto in consultas.items():
+        if consulta_texto is None:
+            consultas[cnpj] = await _consultar_simples_automacao(cnpj, automacao_lock)
+
+    itens = {
+        filename: (texto_nota, consultas[cnpj_regex], conhecidos)
+        for filename, (texto_nota, cnpj_regex, conhecidos) in preparadas.items()
+        if cnpj_regex
+    }
+    resultados = await ai_client.ai_extract_invoice_and_simples_batch(itens) if itens else {}
+
+    await asyncio.gather(*[concluir(filename, resultados.get(filename)) for filename in preparadas])
+    if not extraidas:
+        return
+
+    # One pass of the rules engine over every invoice, so each consensus step runs once for the batch.
+    nomes = list(extraidas)
+    df_nf = pd.DataFrame([extraidas[nome][0] for nome in nomes])
+    simples_df = pd.DataFrame([{'is_optante_simples': status.is_optante_simples, 'is_simei': status.is_simei}
+                               for _, status, _ in extraidas.values()])
+    try:
+        mapa_df = rules_engine.processar_regras_fiscais_batch(df_nf, simples_df, user_config, rules,
+                                                              [texto for _, _, texto in extraidas.values()])
+        mapas: Optional[Dict[int, MapaRow]] = {}
+        for i, registro in zip(mapa_df.index, mapa_df.to_dict('records')):
+            # The frame has the union of every invoice's fields: drop the NaN fillers of the fields this invoice lacks.
+            faltantes = df_nf.columns.difference(list(extraidas[nomes[i]][0]))
+            mapas[i] = MapaRow.from_record({k: v for k, v in registro.items()
+                                            if k not in faltantes or not (pd.api.types.is_scalar(v) and pd.isna(v))})
+    except Exception as e:
+        # Rows the engine cannot handle are triaged out; an unexpected failure must not
+        # send the whole batch to manual, so the rules are reapplied invoice by invoice.
+        print(f"  [AVISO] Falha no motor de regras para o lote ({e}). Aplicando as regras nota a nota.")
+        mapas = None
+
+    for i, filename in enumerate(nomes):
+        print(f"\n--- Gerando MAPA: {filename} ---")
+        try:
+            if mapas is None:
+                dados_nf, simples_status, texto_nota = extraidas[filename]
+                mapa_row = rules_engine.processar_regras_fiscais(dados_nf, simples_status, user_config, rules, texto_nota)
+            else:
+                mapa_row = mapas.get(i)
+            if mapa_row is None:
+                # This means the rules engine decided the file should go to manual review.
+                raise ValueError("Nota não passou na triagem do motor de regras.")
+            _gerar_mapa(filename, source_folder, mapa_row, user_config, output_folders, relatorio_final)
+        except Exception as e:
+            _mover_para_manual(filename, source_folder, output_folders, e)
+
+def _imprimir_resumo(relatorio_final: List[MapaRow]):
+    """Prints the per-supplier totals of the generated MAPAs."""
+    df = pd.DataFrame([(row.nome_fornecedor, row.valor_total, row.valor_total_retencoes) for row in relatorio_final],
+                      columns=['nome_fornecedor', 'valor_total', 'valor_total_retencoes'])
+    # The AI may return amounts as strings; coerce once, column-wide.
+    for col in ('valor_total', 'valor_total_retencoes'):
+        df[col] = pd.to_numeric(df[col], errors='coerce').fillna(0.0)
+    df['nome_fornecedor'] = df['nome_fornecedor'].fillna('(não identificado)')
+
+    resumo = df.groupby('nome_fornecedor').agg(
+        notas=('valor_total', 'size'),
+        valor_total=('valor_total', 'sum'),
+        retencoes=('valor_total_retencoes', 'sum'),
+    )
+    print("Resumo dos MAPAs gerados:")
+    for linha in resumo.itertuples():
+        print(f"  - Fornecedor: {linha.Index}, Notas: {linha.notas}, Valor: R${linha.valor_total:.2f}, Retenções: R${linha.retencoes:.2f}")
+    print(f"  Total: {len(df)} MAPA(s), Valor: R${df['valor_total'].sum():.2f}, Retenções: R${df['valor_total_retencoes'].sum():.2f}")
+
 def main():
     """Main application workflow."""
     print("--- Iniciando Automação de MAPA de NFS-e ---")
@@ -70,88 +354,39 @@ def main():
     if not user_config:
         print("Configuração inicial cancelada. Encerrando.")
         return
+    if "--batch" in sys.argv[1:]:
+        user_config = dataclasses.replace(user_config, use_batch_api=True)
 
     # 4. Main Processing Loop
     output_folders = _setup_output_folders(source_folder)
-    relatorio_final: List[Dict[str, Any]] = []
+    relatorio_final: List[MapaRow] = []
 
-    pdf_files = [f for f in os.listdir(source_folder) if f.lower().endswith('.pdf')]
-    if not pdf_files:
+    pdf_files = iter_pdfs(source_folder)
+    primeiro_pdf = next(pdf_files, None)
+    if primeiro_pdf is None:
         ui.show_info("Nenhum PDF Encontrado", "A pasta selecionada não contém arquivos PDF para processar.")
         return
 
     # --- SIMULATED AND ONE-TIME ACTIONS ---
     # In a real run, these would be dynamic.
-    simples_automator.abrir_chrome_e_site() # Simulate opening the browser once
+    if config.SIMPLES_AUTOMACAO_FALLBACK:
+        simples_automator.abrir_chrome_e_site() # Simulate opening the browser once
     default_tomador_cnpj = "01.234.567/0001-89" # Mock CNPJ
 
-    for filename in pdf_files:
-        original_filepath = os.path.join(source_folder, filename)
-
-        # Simple filter to avoid processing already generated MAPAs
-        if "mapa" in filename.lower():
-            continue
-
-        print(f"\n--- Processando Arquivo: {filename} ---")
-
-        try:
-            texto_nota = pdf_processor.extrair_texto_inteligente(original_filepath)
-            if not texto_nota:
-                raise ValueError("Extração de texto resultou em conteúdo insuficiente.")
-
-            dados_nf = ai_client.ai_extract_invoice_data(texto_nota)
-            if not dados_nf or not dados_nf.get('cnpj_prestador'):
-                raise ValueError("IA falhou ao extrair dados essenciais da nota.")
-
-            # SIMPLES Consultation (Simulated)
-            consulta_texto = simples_automator.consultar_simples_via_automacao(dados_nf['cnpj_prestador'])
-            simples_status_raw = ai_client.ai_analyze_simples_status(consulta_texto, dados_nf['data_emissao'])
-            simples_status = {
-                'is_optante_simples': simples_status_raw.get('optante_simples') == 'optante',
-                'is_simei': simples_status_raw.get('status_simei') == 'simei'
-            }
-
-            mapa_data = rules_engine.processar_regras_fiscais(dados_nf, simples_status, user_config, rules, texto_nota)
-
-            if mapa_data is None:
-                # This means the rules engine decided the file should go to manual review.
-                raise ValueError("Nota não passou na triagem do motor de regras.")
-
-            # Add final details to mapa_data
-            mapa_data['titulo_mapa'] = f"{user_config['nome_unidade']} - {mapa_data['nome_fornecedor']}"
-            if user_config.get('preencher_chamado'):
-                match = re.search(r'\d+', filename)
-                mapa_data['numero_chamado'] = match.group(0) if match else ''
-
-            # Generate MAPA PDF
-            output_pdf_path = os.path.join(output_folders['mapas_pdf'], f"{os.path.splitext(filename)[0]}_MAPA.pdf")
-            mapa_generator.gerar_mapa_pdf(mapa_data, output_pdf_path)
-
-            # Move processed original file
-            final_nota_path = os.path.join(output_folders['notas_geradas'], filename)
-            os.rename(original_filepath, final_nota_path)
-            print(f"-> Sucesso! Nota movida para: {output_folders['notas_geradas']}")
-            relatorio_final.append(mapa_data)
-
-        except Exception as e:
-            print(f"  [ERRO NO PROCESSAMENTO] Falha ao processar '{filename}': {e}")
-            manual_path = os.path.join(output_folders['manual'], filename)
-            try:
-                os.rename(original_filepath, manual_path)
-                print(f"-> Arquivo movido para revisão manual: {output_folders['manual']}")
-            except Exception as move_error:
-                print(f"  [ERRO CRÍTICO] Não foi possível mover o arquivo de erro '{filename}': {move_error}")
+    # The Batch API is cheaper but asynchronous (results may take hours).
+    processar = _processar_lote_batch if user_config.use_batch_api else _processar_lote
+    asyncio.run(processar(itertools.chain([primeiro_pdf], pdf_files), source_folder, user_config, rules, output_folders, relatorio_final))
 
     # 5. Finalization
     print("\n--- Processamento em Lote Concluído ---")
     if relatorio_final:
-        print("Resumo dos MAPAs gerados:")
-        for item in relatorio_final:
-            print(f"  - Fornecedor: {item['nome_fornecedor']}, Valor: R${item['valor_total']:.2f}, Retenções: R${item['valor_total_retencoes']:.2f}")
+        _imprimir_resumo(relatorio_final)
 
     ui.show_info("Processamento Concluído", "Todos os arquivos foram processados.\nVerifique as pastas de saída para os resultados.")
 
 if __name__ == "__main__":
+    # Required for the OCR process pool in frozen (PyInstaller) Windows builds.
+    multiprocessing.freeze_support()
     # Wrap in a try-except to catch any unhandled exceptions and show them to the user.
     try:
         main()
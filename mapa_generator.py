@@ -1,15 +1,17 @@
 # mapa_generator.py
 # Uses reportlab to generate the MAPA PDF report from scratch.
-from typing import Dict, Any, List
+import os
 
 from reportlab.pdfgen import canvas
 from reportlab.lib.pagesizes import A4
 from reportlab.lib.units import cm
 from reportlab.lib.colors import HexColor
-from reportlab.lib.styles import getSampleStyleSheet
+from reportlab.lib.styles import ParagraphStyle
 from reportlab.platypus import Paragraph
 from reportlab.lib.enums import TA_CENTER, TA_RIGHT
 
+from models import MapaRow
+
 # --- Constants ---
 PAGE_WIDTH, PAGE_HEIGHT = A4
 MARGIN = 1 * cm
@@ -18,6 +20,30 @@ ORANGE_COLOR = HexColor("#F79646")
 GRAY_COLOR = HexColor("#F2F2F2")
 FONT_NAME = "Helvetica"
 FONT_BOLD = "Helvetica-Bold"
+TEXT_FONT_SIZE = 9
+BOX_PADDING = 4
+
+# --- Layout ---
+# The page size is fixed, so every box geometry is computed once at import.
+BOX_GAP = 10
+ID_BOX_H = 30
+ID_BOX_W = (CONTENT_WIDTH - 2 * BOX_GAP) / 3
+ID_X = tuple(MARGIN + i * (ID_BOX_W + BOX_GAP) for i in range(3))
+TAX_BOX_H = 40
+TAX_BOX_W = (CONTENT_WIDTH - 3 * BOX_GAP) / 4
+TAX_X = tuple(MARGIN + i * (TAX_BOX_W + BOX_GAP) for i in range(4))
+OBS_BOX_H = 3 * cm
+
+# (label, rate field, amount field) of each MapaRow tax box, left to right.
+_TAX_BOXES = (
+    ("ISS", 'aliquota_iss', 'valor_iss_retido'),
+    ("INSS", 'aliquota_inss', 'valor_inss_retido'),
+    ("IRRF", 'aliquota_irrf', 'valor_irrf_retido'),
+    ("CSRF", 'aliquota_csrf', 'valor_csrf_retido'),
+)
+
+# Built once and shared by every Paragraph; creating a style sheet per box is expensive.
+_TEXT_STYLE = ParagraphStyle('mapa_text', fontName=FONT_NAME, fontSize=TEXT_FONT_SIZE, leading=12)
 
 # --- Drawing Utilities ---
 
@@ -37,16 +63,25 @@ def _draw_rounded_box(c: canvas.Canvas, x: float, y: float, width: float, height
 
 def _draw_text_in_box(c: canvas.Canvas, text: str, x: float, y: float, width: float, height: float):
     """Draws text, wrapping it if necessary, inside a given bounding box."""
-    styles = getSampleStyleSheet()
-    style = styles['Normal']
-    style.fontName = FONT_NAME
-    style.fontSize = 9
-    p = Paragraph(text, style)
-    p.wrapOn(c, width - 8, height - 8) # Add some padding
-    p.drawOn(c, x + 4, y + (height - p.height) / 2 - 4)
-
-def _draw_header_footer(c: canvas.Canvas, dados_mapa: Dict[str, Any]):
-    """Draws the standard page header and footer."""
+    # Fast path: single-line values (CNPJ, amounts, codes) are drawn directly,
+    # skipping Paragraph parsing and wrapping. The baseline matches the Paragraph layout.
+    if '\n' not in text and c.stringWidth(text, FONT_NAME, TEXT_FONT_SIZE) <= width - 2 * BOX_PADDING:
+        c.saveState()
+        # Same colour as the Paragraph path; the header drawing leaves the fill white.
+        c.setFillColor(_TEXT_STYLE.textColor)
+        c.setFont(FONT_NAME, TEXT_FONT_SIZE)
+        c.drawString(x + BOX_PADDING, y + (height - _TEXT_STYLE.leading) / 2 - BOX_PADDING + _TEXT_STYLE.leading - TEXT_FONT_SIZE, text)
+        c.restoreState()
+        return
+    p = Paragraph(text, _TEXT_STYLE)
+    p.wrapOn(c, width - 2 * BOX_PADDING, height - 2 * BOX_PADDING) # Add some padding
+    p.drawOn(c, x + BOX_PADDING, y + (height - p.height) / 2 - BOX_PADDING)
+
+# Name of the form XObject holding the static header/footer artwork.
+_HEADER_FORM_NAME = "mapa_header_footer"
+
+def _draw_header_static(c: canvas.Canvas):
+    """Draws the parts of the header and footer that are identical on every page."""
     # Header
     c.setFillColor(ORANGE_COLOR)
     c.rect(0, PAGE_HEIGHT - (2 * cm), PAGE_WIDTH, 2 * cm, fill=1, stroke=0)
@@ -55,9 +90,6 @@ def _draw_header_footer(c: canvas.Canvas, dados_mapa: Dict[str, Any]):
     c.setFont(FONT_BOLD, 12)
     c.drawRightString(PAGE_WIDTH - MARGIN, PAGE_HEIGHT - (1.5 * cm), "Taxs Contabilidade")
 
-    c.setFont(FONT_BOLD, 16)
-    c.drawCentredString(PAGE_WIDTH / 2, PAGE_HEIGHT - (1.5 * cm), dados_mapa.get('titulo_mapa', 'MAPA DE ANÁLISE'))
-
     # Footer
     c.setFillColor(ORANGE_COLOR)
     c.rect(0, 0, PAGE_WIDTH, 1 * cm, fill=1, stroke=0)
@@ -65,9 +97,24 @@ def _draw_header_footer(c: canvas.Canvas, dados_mapa: Dict[str, Any]):
     c.setFont(FONT_NAME, 10)
     c.drawCentredString(PAGE_WIDTH / 2, 0.4 * cm, "www.taxs.com.br")
 
+def _define_header_form(c: canvas.Canvas):
+    """Records the static header/footer once per document as a reusable form XObject."""
+    c.beginForm(_HEADER_FORM_NAME)
+    _draw_header_static(c)
+    c.endForm()
+
+def _draw_header_footer(c: canvas.Canvas, mapa: MapaRow):
+    """Draws the standard page header and footer."""
+    # The static artwork is a single reference to the form; only the title varies.
+    c.doForm(_HEADER_FORM_NAME)
+
+    c.setFillColorRGB(1, 1, 1)
+    c.setFont(FONT_BOLD, 16)
+    c.drawCentredString(PAGE_WIDTH / 2, PAGE_HEIGHT - (1.5 * cm), mapa.titulo_mapa)
+
 # --- Main PDF Generation Function ---
 
-def gerar_mapa_pdf(dados_mapa: Dict[str, Any], caminho_pdf_saida: str):
+def gerar_mapa_pdf(mapa: MapaRow, caminho_pdf_saida: str):
     """
     Generates the final MAPA PDF report from the processed data.
     """
@@ -75,24 +122,24 @@ def gerar_mapa_pdf(dados_mapa: Dict[str, Any], caminho_pdf_saida: str):
     try:
         c = canvas.Canvas(caminho_pdf_saida, pagesize=A4)
 
-        _draw_header_footer(c, dados_mapa)
+        _define_header_form(c)
+        _draw_header_footer(c, mapa)
 
         # --- Section 1: Identification ---
         y_pos = PAGE_HEIGHT - (3 * cm)
-        _draw_rounded_box(c, MARGIN, y_pos, CONTENT_WIDTH, 30, "Fornecedor")
-        _draw_text_in_box(c, dados_mapa.get('fornecedor', ''), MARGIN, y_pos, CONTENT_WIDTH, 30)
+        _draw_rounded_box(c, MARGIN, y_pos, CONTENT_WIDTH, ID_BOX_H, "Fornecedor")
+        _draw_text_in_box(c, mapa.nome_fornecedor or '', MARGIN, y_pos, CONTENT_WIDTH, ID_BOX_H)
 
         # This is a simplified layout. A real version would need more precise coordinate calculations.
         y_pos -= 1.5 * cm
-        box_width = (CONTENT_WIDTH - 20) / 3
-        _draw_rounded_box(c, MARGIN, y_pos, box_width, 30, "Unidade")
-        _draw_text_in_box(c, dados_mapa.get('unidade', ''), MARGIN, y_pos, box_width, 30)
+        _draw_rounded_box(c, ID_X[0], y_pos, ID_BOX_W, ID_BOX_H, "Unidade")
+        _draw_text_in_box(c, mapa.unidade, ID_X[0], y_pos, ID_BOX_W, ID_BOX_H)
 
-        _draw_rounded_box(c, MARGIN + box_width + 10, y_pos, box_width, 30, "Cód. Serviço (LC 116)")
-        _draw_text_in_box(c, dados_mapa.get('cod_servico_lc116', ''), MARGIN + box_width + 10, y_pos, box_width, 30)
+        _draw_rounded_box(c, ID_X[1], y_pos, ID_BOX_W, ID_BOX_H, "Cód. Serviço (LC 116)")
+        _draw_text_in_box(c, mapa.cod_servico_lc116, ID_X[1], y_pos, ID_BOX_W, ID_BOX_H)
 
-        _draw_rounded_box(c, MARGIN + 2 * (box_width + 10), y_pos, box_width, 30, "Tipo de Atividade (CNAE)")
-        _draw_text_in_box(c, dados_mapa.get('cnae_descricao', ''), MARGIN + 2 * (box_width + 10), y_pos, box_width, 30)
+        _draw_rounded_box(c, ID_X[2], y_pos, ID_BOX_W, ID_BOX_H, "Tipo de Atividade (CNAE)")
+        _draw_text_in_box(c, mapa.cnae_descricao, ID_X[2], y_pos, ID_BOX_W, ID_BOX_H)
 
         # --- Section 2: Values ---
         y_pos -= 2 * cm
@@ -100,23 +147,9 @@ def gerar_mapa_pdf(dados_mapa: Dict[str, Any], caminho_pdf_saida: str):
         c.drawString(MARGIN, y_pos, "Valores dos Impostos a Serem Retidos")
 
         y_pos -= 1.5 * cm
-        tax_box_width = (CONTENT_WIDTH - 30) / 4
-
-        # ISS
-        _draw_rounded_box(c, MARGIN, y_pos, tax_box_width, 40, f"ISS ({dados_mapa.get('aliquota_iss', 0):.2%})")
-        _draw_text_in_box(c, f"R$ {dados_mapa.get('valor_iss_retido', 0):.2f}".replace('.',','), MARGIN, y_pos, tax_box_width, 40)
-
-        # INSS
-        _draw_rounded_box(c, MARGIN + tax_box_width + 10, y_pos, tax_box_width, 40, f"INSS ({dados_mapa.get('aliquota_inss', 0):.2%})")
-        _draw_text_in_box(c, f"R$ {dados_mapa.get('valor_inss_retido', 0):.2f}".replace('.',','), MARGIN + tax_box_width + 10, y_pos, tax_box_width, 40)
-
-        # IRRF
-        _draw_rounded_box(c, MARGIN + 2 * (tax_box_width + 10), y_pos, tax_box_width, 40, f"IRRF ({dados_mapa.get('aliquota_irrf', 0):.2%})")
-        _draw_text_in_box(c, f"R$ {dados_mapa.get('valor_irrf_retido', 0):.2f}".replace('.',','), MARGIN + 2 * (tax_box_width + 10), y_pos, tax_box_width, 40)
-
-        # CSRF
-        _draw_rounded_box(c, MARGIN + 3 * (tax_box_width + 10), y_pos, tax_box_width, 40, f"CSRF ({dados_mapa.get('aliquota_csrf', 0):.2%})")
-        _draw_text_in_box(c, f"R$ {dados_mapa.get('valor_csrf_retido', 0):.2f}".replace('.',','), MARGIN + 3 * (tax_box_width + 10), y_pos, tax_box_width, 40)
+        for x, (label, chave_aliquota, chave_valor) in zip(TAX_X, _TAX_BOXES):
+            _draw_rounded_box(c, x, y_pos, TAX_BOX_W, TAX_BOX_H, f"{label} ({getattr(mapa, chave_aliquota):.2%})")
+            _draw_text_in_box(c, f"R$ {getattr(mapa, chave_valor):.2f}".replace('.',','), x, y_pos, TAX_BOX_W, TAX_BOX_H)
 
         # --- Section 3: Justifications ---
         y_pos -= 4 * cm
@@ -124,8 +157,8 @@ def gerar_mapa_pdf(dados_mapa: Dict[str, Any], caminho_pdf_saida: str):
         c.drawString(MARGIN, y_pos, "Legislação e Observações")
 
         y_pos -= 0.5 * cm
-        obs_text = "\n".join(f"- {obs}" for obs in dados_mapa.get('observacoes_legais', []))
-        _draw_text_in_box(c, obs_text, MARGIN, y_pos - (3*cm), CONTENT_WIDTH, 3*cm)
+        obs_text = "\n".join(f"- {obs}" for obs in mapa.observacoes_legais)
+        _draw_text_in_box(c, obs_text, MARGIN, y_pos - OBS_BOX_H, CONTENT_WIDTH, OBS_BOX_H)
 
         c.showPage()
         c.save()
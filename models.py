@@ -0,0 +1,79 @@
+# models.py
+# Immutable records passed between the UI, the processing pipeline and the rules engine.
+import dataclasses
+from dataclasses import dataclass
+from typing import Dict, Any, Optional, Tuple
+
+@dataclass(frozen=True, slots=True)
+class UserConfig:
+    """Processing settings chosen in the initial questions dialog."""
+    nome_unidade: str
+    substituto_tributario: bool
+    possui_cebas: bool
+    preencher_chamado: bool = False
+    use_batch_api: bool = False
+
+@dataclass(frozen=True, slots=True)
+class SimplesStatus:
+    """Simples Nacional situation of the prestador on the invoice date."""
+    is_optante_simples: bool = False
+    is_simei: bool = False
+
+    @classmethod
+    def from_analise(cls, analise: Dict[str, Any]) -> 'SimplesStatus':
+        """Builds the status from the AI analysis of the consultation ({'optante_simples': ..., 'status_simei': ...})."""
+        return cls(is_optante_simples=analise.get('optante_simples') == 'optante',
+                   is_simei=analise.get('status_simei') == 'simei')
+
+@dataclass(slots=True)
+class MapaRow:
+    """
+    Everything printed on one MAPA: the rules engine's results plus the invoice fields.
+    Mutable, since the pipeline fills in the title and ticket number after the rules engine.
+    """
+    # Rules engine results
+    unidade: str
+    optante_simples_str: str
+    cod_servico_lc116: str
+    desc_lc116: str
+    cnae_codigo: str
+    cnae_descricao: str
+    cnae_anexo: Optional[str]
+    cnae_art_219: Optional[str]
+    codigo_reinf: str
+    descricao_reinf: str
+    aliquota_iss: float
+    valor_iss_retido: float
+    aliquota_inss: float
+    valor_inss_retido: float
+    aliquota_irrf: float
+    valor_irrf_retido: float
+    aliquota_csrf: float
+    valor_csrf_retido: float
+    valor_total_retencoes: float
+    valor_liquido: float
+    observacoes_legais: Tuple[str, ...]
+    # Invoice fields (ai_client.INVOICE_FIELDS); None when not extracted
+    cnpj_prestador: Optional[str] = None
+    data_emissao: Optional[str] = None
+    nome_fornecedor: Optional[str] = None
+    descricao_servico: Optional[str] = None
+    codigo_servico_municipal: Optional[str] = None
+    subitem_lc116: Optional[str] = None
+    numero_nf: Optional[str] = None
+    valor_total: Optional[float] = None
+    municipio_prestador: Optional[str] = None
+    municipio_tomador: Optional[str] = None
+    # Filled in by the pipeline
+    titulo_mapa: str = 'MAPA DE ANÁLISE'
+    numero_chamado: str = ''
+
+    @classmethod
+    def from_record(cls, record: Dict[str, Any]) -> 'MapaRow':
+        """Builds the row from a processar_regras_fiscais_batch record; columns that are not fields are ignored."""
+        return cls(**{campo: record[campo] for campo in _MAPA_ROW_FIELDS if campo in record})
+
+    def asdict(self) -> Dict[str, Any]:
+        return dataclasses.asdict(self)
+
+_MAPA_ROW_FIELDS = tuple(campo.name for campo in dataclasses.fields(MapaRow))
@@ -1,53 +1,122 @@
 # pdf_processor.py
-# Logic for PDF text extraction using PyPDF2 and OCR fallback.
+# Logic for PDF text extraction using PyMuPDF (or PyPDF2) and OCR fallback.
 import os
-from typing import Optional
+import atexit
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional, List
 
 import PyPDF2
 from pdf2image import convert_from_path
 import pytesseract
 
+# PyMuPDF parses content streams in C and is much faster than PyPDF2;
+# PyPDF2 remains the fallback when it is not installed.
+try:
+    import pymupdf
+except ImportError:
+    try:
+        import fitz as pymupdf # Older PyMuPDF releases
+    except ImportError:
+        pymupdf = None
+
 from config import TESSERACT_CMD
 
 # Set the Tesseract command path
 pytesseract.pytesseract.tesseract_cmd = TESSERACT_CMD
 
-def _extract_text_with_pypdf2(pdf_path: str) -> str:
-    """Extracts text from a PDF using PyPDF2."""
-    text = []
+# A page (or document) with fewer characters than this is treated as image-only.
+MIN_TEXT_CHARS = 100
+
+def _extract_text_with_pymupdf(pdf_path: str) -> List[str]:
+    """Extracts the embedded text of each page using PyMuPDF ('' for pages without text)."""
+    try:
+        with pymupdf.open(pdf_path) as doc:
+            return [page.get_text("text") for page in doc]
+    except Exception as e:
+        print(f"  [PyMuPDF Error] Falha ao ler o PDF: {e}")
+        return []
+
+def _extract_text_with_pypdf2(pdf_path: str) -> List[str]:
+    """Extracts the embedded text of each page using PyPDF2 ('' for pages without text)."""
+    pages = []
     try:
         with open(pdf_path, 'rb') as f:
             reader = PyPDF2.PdfReader(f)
             for page in reader.pages:
-                page_text = page.extract_text()
-                if page_text:
-                    text.append(page_text)
+                pages.append(page.extract_text() or "")
     except Exception as e:
         print(f"  [PyPDF2 Error] Falha ao ler o PDF: {e}")
-        return ""
-    return "\n".join(text)
+        return []
+    return pages
 
-def _extract_text_with_ocr(pdf_path: str) -> str:
-    """Extracts text from a PDF using OCR (Tesseract)."""
+# --- OCR Worker Pool ---
+# Tesseract is single-threaded per call, so pages are OCR'd in parallel processes.
+# The pool is created on first use and shared by every PDF in the run.
+_ocr_executor: Optional[ProcessPoolExecutor] = None
+# Invoices are extracted from several asyncio.to_thread workers; only one may create the pool.
+_ocr_executor_lock = threading.Lock()
+
+def _get_ocr_executor() -> ProcessPoolExecutor:
+    global _ocr_executor
+    if _ocr_executor is None:
+        with _ocr_executor_lock:
+            if _ocr_executor is None:
+                # Windows has no fork; be explicit so frozen builds behave the same way.
+                mp_context = multiprocessing.get_context('spawn') if os.name == 'nt' else None
+                executor = ProcessPoolExecutor(max_workers=os.cpu_count(), mp_context=mp_context)
+                atexit.register(executor.shutdown)
+                _ocr_executor = executor
+    return _ocr_executor
+
+def _ocr_page(image) -> str:
+    """OCRs a single page image. Top-level so it can run in a worker process."""
+    # lang='por' for Portuguese
+    return pytesseract.image_to_string(image, lang='por')
+
+def _render_pages(pdf_path: str, pages: Optional[List[int]]) -> list:
+    """Renders the given 0-based pages (or all pages) as grayscale images."""
+    # NFS-e text is clean enough for 200 DPI grayscale, which is far less
+    # pixel data for Tesseract than 300 DPI RGB. pdftocairo (shipped with
+    # poppler-utils) renders faster than pdftoppm; images stay in memory and
+    # go straight to pytesseract as PIL images.
+    options = dict(dpi=200, grayscale=True, fmt='jpeg', use_pdftocairo=True, thread_count=os.cpu_count())
+    if pages is None:
+        return convert_from_path(pdf_path, **options)
+    images = []
+    for page in pages:
+        images.extend(convert_from_path(pdf_path, first_page=page + 1, last_page=page + 1, **options))
+    return images
+
+def _extract_text_with_ocr(pdf_path: str, pages: Optional[List[int]] = None) -> List[str]:
+    """
+    Extracts text from a PDF using OCR (Tesseract), one string per page.
+    `pages` restricts OCR to the given 0-based page indexes.
+    """
     text = []
     try:
         print("  [OCR] Convertendo PDF para imagens...")
-        images = convert_from_path(pdf_path, 300) # 300 DPI for better quality
+        images = _render_pages(pdf_path, pages)
         print(f"  [OCR] Extraindo texto de {len(images)} página(s)...")
-        for i, image in enumerate(images):
-            # lang='por' for Portuguese
-            page_text = pytesseract.image_to_string(image, lang='por')
+        if len(images) > 1:
+            # executor.map keeps the original page order.
+            page_texts = _get_ocr_executor().map(_ocr_page, images)
+        else:
+            page_texts = map(_ocr_page, images)
+        for i, page_text in enumerate(page_texts):
             text.append(page_text)
             print(f"    - Página {i+1} processada.")
     except Exception as e:
         print(f"  [OCR Error] Falha no processo de OCR: {e}")
-        return ""
-    return "\n".join(text)
+        return []
+    return text
 
 def extrair_texto_inteligente(pdf_path: str) -> Optional[str]:
     """
     Intelligently extracts text from a PDF. It first tries to extract
-    embedded text. If the result is insufficient, it falls back to OCR.
+    embedded text per page, then runs OCR only on the pages whose embedded
+    text is insufficient.
 
     Returns the extracted text, or None if both methods fail to produce
     meaningful content.
@@ -55,22 +124,34 @@ def extrair_texto_inteligente(pdf_path: str) -> Optional[str]:
     print(f"Iniciando extração de texto para: {os.path.basename(pdf_path)}")
 
     # 1. Try native text extraction first
-    native_text = _extract_text_with_pypdf2(pdf_path)
+    if pymupdf is not None:
+        pages_text = _extract_text_with_pymupdf(pdf_path)
+    else:
+        pages_text = _extract_text_with_pypdf2(pdf_path)
 
     # Heuristic to check if the text is sufficient
-    # We check for more than just a few characters.
-    if native_text and len(native_text.strip()) > 100:
+    # We check for more than just a few characters on each page.
+    ocr_pages = [i for i, page_text in enumerate(pages_text) if len(page_text.strip()) < MIN_TEXT_CHARS]
+    if pages_text and not ocr_pages:
         print("  -> Extração de texto nativo bem-sucedida.")
-        return native_text.strip()
-
-    print("  -> Texto nativo insuficiente ou ausente. Iniciando fallback para OCR.")
+        return "\n".join(pages_text).strip()
 
-    # 2. Fallback to OCR
-    ocr_text = _extract_text_with_ocr(pdf_path)
+    # 2. Fallback to OCR, only for the pages that need it
+    if not pages_text:
+        # The PDF could not be read at all, so OCR every page.
+        print("  -> Texto nativo ausente. Iniciando fallback para OCR.")
+        pages_text = _extract_text_with_ocr(pdf_path)
+    else:
+        print(f"  -> Texto nativo insuficiente em {len(ocr_pages)} página(s). Iniciando fallback para OCR.")
+        ocr_texts = _extract_text_with_ocr(pdf_path, ocr_pages)
+        for page, ocr_text in zip(ocr_pages, ocr_texts):
+            if len(ocr_text.strip()) > len(pages_text[page].strip()):
+                pages_text[page] = ocr_text
 
-    if ocr_text and len(ocr_text.strip()) > 100:
+    final_text = "\n".join(pages_text).strip()
+    if len(final_text) > MIN_TEXT_CHARS:
         print("  -> Extração via OCR bem-sucedida.")
-        return ocr_text.strip()
+        return final_text
 
     print("  [FALHA] Extração de texto falhou. O PDF pode estar vazio ou ilegível.")
     return None
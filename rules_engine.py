@@ -1,43 +1,230 @@
 # rules_engine.py
 # The fiscal rules engine for retention calculations and data classification.
+import importlib.util
+import os
 import re
 import json
+import pickle
+import sys
+import unicodedata
 from typing import Dict, Any, Optional, Tuple, List
 from datetime import datetime
 
+import numpy as np
 import pandas as pd
-from difflib import get_close_matches
 
-from config import DECISOES_CACHE_FILENAME, CODIGOS_SERVICO_EXCECAO_NAO_OPTANTE
+from config import USER_DIR, DECISOES_CACHE_FILENAME, RULES_CACHE_FILENAME, CODIGOS_SERVICO_EXCECAO_NAO_OPTANTE
 from assets import asset_path
+from models import UserConfig, SimplesStatus, MapaRow
+
+# Required, not optional: the matched CNAE decides the INSS retention, so every
+# machine must score descriptions the same way (no difflib fallback).
+from rapidfuzz import process as fuzz_process, fuzz, utils as fuzz_utils
+
+# Optional dependency: with numba the retention kernels are compiled; without it they run as plain Python.
+try:
+    from numba import njit, prange
+except ImportError:
+    njit = None
+    prange = range
 # Placeholder for AI client functions that will be called
 # from ai_client import (ai_get_lc116_from_text, ai_get_reinf_from_text,
 #                        ai_get_iss_aliquota, ai_get_cnae_from_description)
 
 # --- Data Loading ---
 
+_CODIGOS_EXCECAO = frozenset(CODIGOS_SERVICO_EXCECAO_NAO_OPTANTE)
+
+# "1.07 - Suporte técnico em informática..." -> ("1.07", "Suporte técnico...")
+# Matched over the whole file; [ \t] instead of \s so a match never spans lines.
+_LC116_LINE_RE = re.compile(r'^[ \t]*([\d.]+)[ \t]*-[ \t]*(.*)$', re.MULTILINE)
+# Column name normalization: "Descrição Anexo" -> "descricao_anexo" (after lower())
+_COL_TRANS = str.maketrans({
+    ' ': '_', 'ç': 'c',
+    'á': 'a', 'à': 'a', 'â': 'a', 'ã': 'a',
+    'é': 'e', 'ê': 'e',
+    'í': 'i',
+    'ó': 'o', 'ô': 'o', 'õ': 'o',
+    'ú': 'u', 'ü': 'u',
+})
+
+def _normalize_column_name(col: str) -> str:
+    return str(col).lower().translate(_COL_TRANS)
+
 def _normalize_df_columns(df: pd.DataFrame) -> pd.DataFrame:
     """Normalizes DataFrame column names to a consistent format."""
-    cols = {col: col.lower().replace(' ', '_').replace('ç', 'c').replace('ã', 'a') for col in df.columns}
-    df = df.rename(columns=cols)
+    df.rename(columns={col: _normalize_column_name(col) for col in df.columns}, inplace=True)
+    return df
+
+# Columns of the CNAE table used by the engine (normalized names); the rest of the sheet is not read.
+_CNAE_COLUMNS = frozenset({'cnae', 'descricao', 'anexo', 'retencao', 'art219'})
+
+# The Rust-based calamine reader is much faster than openpyxl; it is optional.
+_EXCEL_ENGINE = 'calamine' if importlib.util.find_spec('python_calamine') is not None else 'openpyxl'
+
+def _read_excel(xlsx_path: str, columns: Optional[frozenset] = None) -> pd.DataFrame:
+    """Reads an xlsx rule table with normalized column names, optionally only `columns`."""
+    # usecols as a callable matches on the normalized header, so accents/case in the sheet don't matter.
+    usecols = (lambda col: _normalize_column_name(col) in columns) if columns else None
+    return _normalize_df_columns(pd.read_excel(xlsx_path, engine=_EXCEL_ENGINE, usecols=usecols))
+
+def _tipar_cnae(df: pd.DataFrame) -> pd.DataFrame:
+    """Integer codes and categorical anexo/retencao (few distinct values repeated on every row)."""
+    df = df.dropna(subset=['cnae']) # Blank trailing rows of the sheet
+    df = df.astype({'cnae': 'int64'})
+    for col in ('anexo', 'retencao'):
+        if col in df:
+            df[col] = df[col].astype('category')
+    return df
+
+def _build_cnae_soa(df: pd.DataFrame) -> Dict[str, Any]:
+    """
+    Column-oriented copy of the CNAE flags used by the retention kernel:
+    `anexo_iv`/`retencao_sim` bool arrays aligned with `code`, and `idx_by_code` (code -> position).
+    """
+    codes = df['cnae'].to_numpy(np.int64)
+    return {
+        'code': codes,
+        'anexo_iv': (df['anexo'].astype(str).str.strip().str.upper() == 'IV').to_numpy(dtype=bool),
+        'retencao_sim': (df['retencao'].astype(str).str.strip().str.upper() == 'SIM').to_numpy(dtype=bool),
+        'idx_by_code': {int(code): i for i, code in enumerate(codes)},
+    }
+
+# --- Per-file Caches ---
+# Each rule file gets a parsed copy next to it (<file>.parquet / <file>.json).
+# A cache is stamped with the mtime of its source and is only valid while the
+# mtimes match exactly: a "newer than" check would miss a replacement file with
+# an older timestamp (shutil.copy2 preserves the original mtime).
+
+# Parquet support is optional (pyarrow); without it the xlsx is always parsed.
+_PARQUET_AVAILABLE = importlib.util.find_spec('pyarrow') is not None
+
+def _cache_is_fresh(cache_path: str, source_path: str) -> bool:
+    # Nanosecond timestamps: float seconds do not round-trip exactly through os.utime.
+    return os.path.exists(cache_path) and os.stat(cache_path).st_mtime_ns == os.stat(source_path).st_mtime_ns
+
+def _stamp_cache(cache_path: str, source_path: str):
+    mtime_ns = os.stat(source_path).st_mtime_ns
+    os.utime(cache_path, ns=(mtime_ns, mtime_ns))
+
+def _load_excel_cached(xlsx_path: str, columns: Optional[frozenset] = None) -> pd.DataFrame:
+    """Reads an xlsx rule table (normalized columns), through its Parquet cache when possible."""
+    cache_path = xlsx_path + '.parquet'
+    if _PARQUET_AVAILABLE and _cache_is_fresh(cache_path, xlsx_path):
+        try:
+            # Renormalized (idempotent), so a cache written before a naming change stays usable.
+            return _normalize_df_columns(pd.read_parquet(cache_path))
+        except Exception as e:
+            print(f"  [AVISO] Cache Parquet ignorado ({os.path.basename(cache_path)}): {e}")
+
+    df = _read_excel(xlsx_path, columns)
+    if _PARQUET_AVAILABLE:
+        try:
+            df.to_parquet(cache_path, compression='zstd')
+            _stamp_cache(cache_path, xlsx_path)
+        except Exception as e:
+            # e.g. a column mixing numbers and text, which Arrow cannot store
+            print(f"  [AVISO] Não foi possível salvar o cache Parquet de '{os.path.basename(xlsx_path)}': {e}")
     return df
 
+def _parse_lc116(lc116_path: str) -> Dict[str, str]:
+    """Parses the LC 116 service list ("1.07 - Descrição" per line)."""
+    with open(lc116_path, 'r', encoding='utf-8') as f:
+        text = f.read()
+    return {m.group(1).strip(): m.group(2).strip() for m in _LC116_LINE_RE.finditer(text)}
+
+def _load_lc116_cached(lc116_path: str) -> Dict[str, str]:
+    """Reads the LC 116 service list through its JSON cache when possible."""
+    cache_path = lc116_path + '.json'
+    if _cache_is_fresh(cache_path, lc116_path):
+        try:
+            with open(cache_path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except Exception as e:
+            print(f"  [AVISO] Cache da LC 116 ignorado: {e}")
+
+    lc116_map = _parse_lc116(lc116_path)
+    try:
+        with open(cache_path, 'w', encoding='utf-8') as f:
+            json.dump(lc116_map, f, ensure_ascii=False)
+        _stamp_cache(cache_path, lc116_path)
+    except Exception as e:
+        print(f"  [AVISO] Não foi possível salvar o cache da LC 116: {e}")
+    return lc116_map
+
+# Bump whenever the structure of the rules dict changes, to invalidate old caches.
+_RULES_CACHE_VERSION = 7
+
+# Rules already loaded in this process, keyed by the files' signature.
+_rules_memo: Dict[Tuple, Dict[str, Any]] = {}
+
+def _rules_signature(paths: Tuple[str, ...]) -> Tuple:
+    """Identifies a set of rule files by path, modification time and size."""
+    return (_RULES_CACHE_VERSION,) + tuple((p, os.path.getmtime(p), os.path.getsize(p)) for p in paths)
+
+def _load_rules_cache(cache_path: str, signature: Tuple) -> Optional[Dict[str, Any]]:
+    """Returns the pickled rules if they were built from the same files, else None."""
+    try:
+        with open(cache_path, 'rb') as f:
+            cached = pickle.load(f)
+        if cached.get('signature') == signature:
+            return cached['rules']
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        print(f"  [AVISO] Cache de regras ignorado: {e}")
+    return None
+
+def _save_rules_cache(cache_path: str, signature: Tuple, rules: Dict[str, Any]):
+    try:
+        with open(cache_path, 'wb') as f:
+            pickle.dump({'signature': signature, 'rules': rules}, f, protocol=pickle.HIGHEST_PROTOCOL)
+    except Exception as e:
+        print(f"  [AVISO] Não foi possível salvar o cache de regras: {e}")
+
 def load_all_rules(cnae_path: str, reinf_path: str, lc116_path: str) -> Dict[str, Any]:
-    """Loads all rule files (CNAE, REINF, LC116) into memory."""
+    """
+    Loads all rule files (CNAE, REINF, LC116) into memory.
+    Parsed rules are memoized in-process and pickled to USER_DIR, and are
+    reused for as long as the three files keep the same mtime and size.
+    """
+    paths = (cnae_path, reinf_path, lc116_path)
+    try:
+        signature = _rules_signature(paths)
+    except OSError as e:
+        print(f"  [ERRO FATAL] Arquivo de regra não encontrado: {e.filename}")
+        return None
+
+    if signature in _rules_memo:
+        return _rules_memo[signature]
+
+    cache_path = os.path.join(USER_DIR, RULES_CACHE_FILENAME)
+    rules = _load_rules_cache(cache_path, signature)
+    if rules is not None:
+        print("-> Regras fiscais carregadas do cache.")
+    else:
+        rules = _parse_all_rules(cnae_path, reinf_path, lc116_path)
+        if rules is None:
+            return None
+        _save_rules_cache(cache_path, signature, rules)
+
+    _rules_memo[signature] = rules
+    return rules
+
+def _parse_all_rules(cnae_path: str, reinf_path: str, lc116_path: str) -> Optional[Dict[str, Any]]:
+    """Parses the rule files (each through its own per-file cache)."""
     print("Carregando arquivos de regras fiscais...")
     rules = {}
     try:
-        rules['cnae'] = _normalize_df_columns(pd.read_excel(cnae_path))
-        rules['reinf'] = _normalize_df_columns(pd.read_excel(reinf_path))
-        with open(lc116_path, 'r', encoding='utf-8') as f:
-            lines = f.readlines()
-
-        lc116_map = {}
-        for line in lines:
-            match = re.match(r'^\s*([\d\.]+)\s*-\s*(.*)', line)
-            if match:
-                lc116_map[match.group(1).strip()] = match.group(2).strip()
-        rules['lc116'] = lc116_map
+        rules['cnae'] = _tipar_cnae(_load_excel_cached(cnae_path, _CNAE_COLUMNS))
+        rules['reinf'] = _load_excel_cached(reinf_path)
+        rules['lc116'] = _load_lc116_cached(lc116_path)
+
+        # Lookup structures built once, so per-invoice lookups are O(1).
+        rules['cnae_by_code'] = {int(row['cnae']): row for row in rules['cnae'].to_dict('records')}
+        rules['cnae_soa'] = _build_cnae_soa(rules['cnae'])
+        # Positional, aligned with rules['cnae'] rows; the fuzzy matcher's choices.
+        rules['cnae_desc_list'] = rules['cnae']['descricao'].fillna('').astype(str).tolist()
         print("-> Arquivos de regras carregados com sucesso.")
         return rules
     except FileNotFoundError as e:
@@ -53,15 +240,45 @@ def load_all_rules(cnae_path: str, reinf_path: str, lc116_path: str) -> Dict[str
 def escolher_lc116_com_consenso(texto_nota, dados_nf, rules) -> Dict[str, str]:
     print("  - Determinando LC 116 (consenso)...")
     # Placeholder: Return a default value based on initial AI extraction
+    codigo = dados_nf.get("subitem_lc116")
+    if not isinstance(codigo, str) or not codigo: # Missing, None or NaN (from a DataFrame row)
+        codigo = "1.07"
     return {
-        "codigo": dados_nf.get("subitem_lc116", "1.07"),
-        "descricao": rules['lc116'].get(dados_nf.get("subitem_lc116", "1.07"), "Serviço Padrão")
+        "codigo": codigo,
+        "descricao": rules['lc116'].get(codigo, "Serviço Padrão")
     }
 
+# The matched CNAE decides the INSS retention, so matching is strict: only the
+# content words are compared (token_set_ratio), and a near-complete overlap is required.
+# Looser scorers (WRatio) pass unrelated descriptions that just share stopwords.
+CNAE_MATCH_CUTOFF = 90
+CNAE_PADRAO = 6204000
+_CNAE_STOPWORDS = frozenset(
+    "a o as os ao aos de da do das dos e em no na nos nas para por com sem ou um uma "
+    "servico servicos atividade atividades outro outros outra outras nao especificado especificados "
+    "especificada especificadas anteriormente referente referentes mes".split()
+)
+
+def _palavras_descricao(texto: str) -> str:
+    """Lower-case, accentless content words of a description (the fuzzy matcher's processor)."""
+    texto = unicodedata.normalize('NFKD', texto).encode('ascii', 'ignore').decode('ascii')
+    return ' '.join(palavra for palavra in fuzz_utils.default_process(texto).split() if palavra not in _CNAE_STOPWORDS)
+
+def _buscar_cnae_por_descricao(descricao: Optional[str], rules) -> Optional[int]:
+    """Returns the CNAE code whose description best matches `descricao`, or None below the cutoff."""
+    choices = rules.get('cnae_desc_list')
+    if not descricao or not choices:
+        return None
+    match = fuzz_process.extractOne(descricao, choices, scorer=fuzz.token_set_ratio,
+                                    processor=_palavras_descricao, score_cutoff=CNAE_MATCH_CUTOFF)
+    idx = match[2] if match else None
+    return None if idx is None else int(rules['cnae']['cnae'].iat[idx])
+
 def escolher_cnae_com_consenso(texto_nota, dados_nf, rules) -> Dict[str, str]:
     print("  - Determinando CNAE (consenso)...")
-    # Placeholder: Use a default, common CNAE for development
-    cnae_row = rules['cnae'][rules['cnae']['cnae'] == 6204000].iloc[0]
+    # Placeholder: match the service description, else use a default, common CNAE for development
+    codigo = _buscar_cnae_por_descricao(dados_nf.get('descricao_servico'), rules)
+    cnae_row = rules['cnae_by_code'][codigo if codigo is not None else CNAE_PADRAO]
     return {
         "codigo": str(cnae_row['cnae']),
         "descricao": cnae_row['descricao'],
@@ -80,93 +297,248 @@ def buscar_aliquota_iss(texto_nota, dados_nf) -> float:
     # Placeholder
     return 0.05 # Default 5%
 
+# --- Consensus Memo ---
+# Invoices of the same prestador and service get the same LC 116/CNAE, so each
+# (cnpj_prestador, subitem_lc116, descricao_servico) combination is resolved once per run.
+_CONSENSO_CACHE: Dict[Tuple, Dict[str, str]] = {}
+
+def _consenso_memoizado(escolher, texto_nota, dados_nf, rules) -> Dict[str, str]:
+    """Calls escolher(texto_nota, dados_nf, rules) unless the same prestador/service was already resolved."""
+    cnpj = dados_nf.get('cnpj_prestador')
+    if not isinstance(cnpj, str) or not cnpj:
+        return escolher(texto_nota, dados_nf, rules) # Without a CNPJ the invoice cannot be grouped
+    chave = (escolher, id(rules), cnpj) + tuple(
+        valor if isinstance(valor, str) else None
+        for valor in (dados_nf.get('subitem_lc116'), dados_nf.get('descricao_servico'))
+    )
+    resultado = _CONSENSO_CACHE.get(chave)
+    if resultado is None:
+        resultado = _CONSENSO_CACHE[chave] = escolher(texto_nota, dados_nf, rules)
+    return resultado
+
+# --- Batched Consensus ---
+# Each consensus step takes the whole batch of (texto_nota, dados_nf) items at once,
+# so an AI-backed version can resolve every invoice in a single prompt.
+
+def escolher_lc116_com_consenso_batch(itens: List[Tuple[str, Dict]], rules) -> List[Dict[str, str]]:
+    return [_consenso_memoizado(escolher_lc116_com_consenso, texto_nota, dados_nf, rules) for texto_nota, dados_nf in itens]
+
+def escolher_cnae_com_consenso_batch(itens: List[Tuple[str, Dict]], rules) -> List[Dict[str, str]]:
+    return [_consenso_memoizado(escolher_cnae_com_consenso, texto_nota, dados_nf, rules) for texto_nota, dados_nf in itens]
+
+def escolher_reinf_com_consenso_batch(itens: List[Tuple[str, Dict]], rules) -> List[Dict[str, str]]:
+    return [escolher_reinf_com_consenso(dados_nf, rules) for _, dados_nf in itens]
+
+def buscar_aliquota_iss_batch(itens: List[Tuple[str, Dict]]) -> List[float]:
+    return [buscar_aliquota_iss(texto_nota, dados_nf) for texto_nota, dados_nf in itens]
+
+# --- Retention Kernels ---
+# numba's on-disk cache needs the .py sources, which frozen (PyInstaller) builds do not ship.
+_NUMBA_CACHE = not getattr(sys, 'frozen', False)
+
+def _jit(**options):
+    """numba.njit(**options) when numba is installed, else a no-op decorator."""
+    return njit(**options) if njit is not None else (lambda func: func)
+
+@_jit(cache=_NUMBA_CACHE, fastmath=True)
+def _compute_retencoes(is_simei, is_optante, same_city, substituto, cebas,
+                       anexo_iv, retencao_sim, lc_301, lc_1009, aliquota_iss):
+    """Returns the (ISS, INSS, IRRF, CSRF) rates applied to one invoice (0.0 where nothing is retained)."""
+    aliquota_iss_applied = 0.0
+    if not is_simei and not lc_301 and same_city and substituto:
+        aliquota_iss_applied = aliquota_iss
+
+    aliquota_inss_applied = 0.0
+    if is_simei:
+        if cebas:
+            aliquota_inss_applied = 0.20
+    elif is_optante and anexo_iv and retencao_sim:
+        aliquota_inss_applied = 0.11
+
+    aliquota_irrf_applied = 0.015 if lc_1009 else 0.0
+    aliquota_csrf_applied = 0.0 # Placeholder
+    return aliquota_iss_applied, aliquota_inss_applied, aliquota_irrf_applied, aliquota_csrf_applied
+
+@_jit(cache=_NUMBA_CACHE, parallel=True)
+def _compute_retencoes_batch(is_simei, is_optante, same_city, substituto, cebas,
+                             anexo_iv, retencao_sim, lc_301, lc_1009, aliquota_iss):
+    """Applies _compute_retencoes to every invoice; returns an (N, 4) array of applied rates."""
+    n = is_simei.shape[0]
+    out = np.zeros((n, 4))
+    for i in prange(n):
+        iss, inss, irrf, csrf = _compute_retencoes(is_simei[i], is_optante[i], same_city[i],
+                                                   substituto, cebas, anexo_iv[i], retencao_sim[i],
+                                                   lc_301[i], lc_1009[i], aliquota_iss[i])
+        out[i, 0] = iss
+        out[i, 1] = inss
+        out[i, 2] = irrf
+        out[i, 3] = csrf
+    return out
+
 # --- Main Rules Engine Function ---
 
-def processar_regras_fiscais(dados_nf: Dict, simples_status: Dict, user_config: Dict, rules: Dict, texto_nota: str) -> Optional[Dict[str, Any]]:
+def _municipios_normalizados(df_nf: pd.DataFrame, coluna: str) -> pd.Series:
     """
-    Orchestrates the entire fiscal rule processing for a single invoice.
-    Returns a dictionary ready for the MAPA generator, or None if the invoice should be manual.
+    The `coluna` municipalities as normalized by utils.normalize_city (NA when blank).
+    Uses the precomputed `<coluna>_norm` column when the caller provides it.
+    """
+    if f'{coluna}_norm' in df_nf:
+        return df_nf[f'{coluna}_norm']
+    texto = df_nf[coluna].astype('string')
+    if texto.isna().all():
+        return texto
+    normalizado = (texto.str.normalize('NFKD').str.encode('ascii', 'ignore').str.decode('ascii').astype('string')
+                   .str.replace(r'\s+', ' ', regex=True).str.strip().str.upper())
+    return normalizado.mask(normalizado == '')
+
+def processar_regras_fiscais_batch(df_nf: pd.DataFrame, simples_df: pd.DataFrame, user_config: UserConfig, rules: Dict,
+                                   textos_notas: List[str]) -> pd.DataFrame:
+    """
+    Orchestrates the fiscal rule processing for many invoices at once.
+    `df_nf` has one row per invoice (the extracted dados_nf), `simples_df` the matching
+    is_optante_simples/is_simei flags and `textos_notas` the invoice texts, all in the same order.
+    Returns one row per invoice that passed triage (same index as `df_nf`) with the
+    MAPA fields (see models.MapaRow.from_record); invoices that must be handled manually are left out.
     """
     print("Iniciando motor de regras fiscais...")
 
-    # 1. Consensus block
-    lc116_final = escolher_lc116_com_consenso(texto_nota, dados_nf, rules)
-    cnae_final = escolher_cnae_com_consenso(texto_nota, dados_nf, rules)
-    reinf_final = escolher_reinf_com_consenso(dados_nf, rules)
-    aliquota_iss = buscar_aliquota_iss(texto_nota, dados_nf)
-
-    # 2. Triage for Non-Simples companies
-    if not simples_status.get('is_optante_simples', False):
-        if lc116_final['codigo'] not in CODIGOS_SERVICO_EXCECAO_NAO_OPTANTE:
-            print(f"  [TRIAGEM] Nota enviada para manual: Prestador não é optante do Simples e o serviço ({lc116_final['codigo']}) não está na lista de exceções.")
-            return None # Skip MAPA generation
-
-    # 3. Retention Calculations
-    valor_total = float(dados_nf.get('valor_total', 0.0))
-    retencoes = {'iss': 0.0, 'inss': 0.0, 'irrf': 0.0, 'csrf': 0.0}
-    justificativas = []
-
-    # 3.1 ISS Retention
-    if simples_status.get('is_simei', False):
-        justificativas.append("ISS não retido (fornecedor SIMEI).")
-    elif lc116_final['codigo'] == '3.01':
-        justificativas.append("ISS não retido (serviço código 3.01 da LC 116).")
-    else:
-        # For now, we simplify the location rule. A real version would use an AI call for 'municipio_iss'.
-        if dados_nf['municipio_prestador'].upper() == dados_nf['municipio_tomador'].upper():
-            if user_config['substituto_tributario']:
-                retencoes['iss'] = valor_total * aliquota_iss
-                justificativas.append(f"ISS retido ({aliquota_iss:.2%}) pelo tomador (mesmo município e substituto tributário).")
-            else:
-                justificativas.append("ISS não retido (unidade não é substituto tributário).")
-        else:
-            justificativas.append("ISS não retido (devido no município do prestador).")
-
-    # 3.2 INSS Retention
-    if simples_status.get('is_simei', False):
-        if user_config['possui_cebas']:
-            retencoes['inss'] = valor_total * 0.20
-            justificativas.append("INSS retido (20%) - Fornecedor SIMEI e tomador com CEBAS.")
-        else:
-            justificativas.append("INSS não retido (fornecedor SIMEI sem tomador com CEBAS).")
-    elif simples_status.get('is_optante_simples', False):
-        if cnae_final.get('anexo') == 'IV' and str(cnae_final.get('retencao')).upper() == 'SIM':
-            retencoes['inss'] = valor_total * 0.11
-            justificativas.append("INSS retido (11%) - Optante do Simples, Anexo IV e serviço sujeito à retenção.")
-        else:
-            justificativas.append("INSS não retido (Optante do Simples fora das regras de retenção).")
-    else: # Not optante
-        justificativas.append("INSS não retido (Não Optante do Simples - regra geral).")
-
-    # 3.3 IRRF (example for 10.09)
-    if lc116_final['codigo'] == '10.09':
-        retencoes['irrf'] = valor_total * 0.015 # 1.5%
-        justificativas.append("IRRF retido (1.5%) para serviços de intermediação (10.09).")
-
-    # 4. Assemble final data dictionary for MAPA
-    total_retencoes = sum(retencoes.values())
-    mapa_data = {
-        **dados_nf,
-        'unidade': user_config['nome_unidade'],
-        'optante_simples_str': "SIM" if simples_status.get('is_optante_simples') else "NÃO",
-        'cod_servico_lc116': lc116_final['codigo'],
-        'desc_lc116': lc116_final['descricao'],
-        'cnae_codigo': cnae_final['codigo'],
-        'cnae_descricao': cnae_final['descricao'],
-        'cnae_anexo': cnae_final['anexo'],
-        'cnae_art_219': cnae_final['art219'],
-        'codigo_reinf': reinf_final['codigo'],
-        'descricao_reinf': reinf_final['descricao'],
-        'aliquota_iss': aliquota_iss,
-        'valor_iss_retido': retencoes['iss'],
-        'aliquota_inss': 0.11 if retencoes['inss'] > 0 and '11%' in justificativas[-1] else (0.20 if retencoes['inss'] > 0 else 0),
-        'valor_inss_retido': retencoes['inss'],
-        'aliquota_irrf': 0.015 if retencoes['irrf'] > 0 else 0,
-        'valor_irrf_retido': retencoes['irrf'],
-        'aliquota_csrf': 0.0, # Placeholder
-        'valor_csrf_retido': 0.0,
+    # 1. LC 116 consensus (needed by the triage)
+    itens = list(zip(textos_notas, df_nf.to_dict('records')))
+    lc116 = escolher_lc116_com_consenso_batch(itens, rules)
+    lc_code = np.array([lc['codigo'] for lc in lc116], dtype=object)
+    is_optante = simples_df['is_optante_simples'].fillna(False).astype(bool).to_numpy()
+    is_simei = simples_df['is_simei'].fillna(False).astype(bool).to_numpy()
+    substituto = user_config.substituto_tributario
+    cebas = user_config.possui_cebas
+
+    # 2. Triage for Non-Simples companies, before the remaining consensus calls
+    manual = ~is_optante & np.array([codigo not in _CODIGOS_EXCECAO for codigo in lc_code], dtype=bool)
+    for codigo in lc_code[manual]:
+        print(f"  [TRIAGEM] Nota enviada para manual: Prestador não é optante do Simples e o serviço ({codigo}) não está na lista de exceções.")
+
+    # For now, we simplify the location rule. A real version would use an AI call for 'municipio_iss'.
+    prestador = _municipios_normalizados(df_nf, 'municipio_prestador')
+    tomador = _municipios_normalizados(df_nf, 'municipio_tomador')
+    same_city = (prestador == tomador).fillna(False).to_numpy(dtype=bool)
+
+    # The ISS location rule cannot be applied without both municipalities.
+    sem_municipio = (prestador.isna() | tomador.isna()).to_numpy() & ~is_simei & (lc_code != '3.01') & ~manual
+    if sem_municipio.any():
+        print(f"  [TRIAGEM] {sem_municipio.sum()} nota(s) enviada(s) para manual: município do prestador ou do tomador não identificado.")
+        manual |= sem_municipio
+
+    # The retentions are computed on the total: a missing or unreadable amount (e.g. "1.234,56") goes to manual.
+    coluna_valor = df_nf['valor_total'] if 'valor_total' in df_nf else pd.Series(np.nan, index=df_nf.index)
+    valor_total = pd.to_numeric(coluna_valor, errors='coerce').astype(float).to_numpy()
+    sem_valor = ~(valor_total > 0) & ~manual # NaN compares False
+    if sem_valor.any():
+        print(f"  [TRIAGEM] {sem_valor.sum()} nota(s) enviada(s) para manual: valor total ausente, inválido ou não positivo.")
+        manual |= sem_valor
+    df_nf = df_nf.assign(valor_total=valor_total)
+
+    # Only the invoices that passed triage go on.
+    if manual.any():
+        keep = ~manual
+        df_nf = df_nf[keep]
+        itens = [item for item, k in zip(itens, keep) if k]
+        lc116 = [lc for lc, k in zip(lc116, keep) if k]
+        lc_code, is_optante, is_simei, same_city = lc_code[keep], is_optante[keep], is_simei[keep], same_city[keep]
+        valor_total = valor_total[keep]
+
+    # 3. Remaining consensus steps, each once for the whole batch (they may query the AI and the rule tables)
+    cnae = escolher_cnae_com_consenso_batch(itens, rules)
+    reinf = escolher_reinf_com_consenso_batch(itens, rules)
+    aliquotas_iss = buscar_aliquota_iss_batch(itens)
+
+    anexo = np.array([c.get('anexo') for c in cnae], dtype=object)
+    # Position of each chosen CNAE in the SoA arrays (-1 if it is not in the table).
+    cnae_soa = rules['cnae_soa']
+    cnae_idx = np.array([cnae_soa['idx_by_code'].get(int(c['codigo']), -1) for c in cnae], dtype=np.int64)
+    aliquota_iss = np.array(aliquotas_iss, dtype=float)
+
+    # 4. Retention Calculations
+    na_tabela = cnae_idx >= 0
+    anexo_iv = cnae_soa['anexo_iv'][cnae_idx] & na_tabela
+    retencao_sim = cnae_soa['retencao_sim'][cnae_idx] & na_tabela
+    lc_301 = lc_code == '3.01'
+    retem_irrf = lc_code == '10.09' # IRRF example for 10.09
+    # The kernel is the single source of truth for the applied rates; the amounts derive from them.
+    aliquotas = _compute_retencoes_batch(is_simei, is_optante, same_city, substituto, cebas,
+                                         anexo_iv, retencao_sim, lc_301, retem_irrf, aliquota_iss)
+    aliquota_iss_applied, aliquota_inss_applied, aliquota_irrf_applied, aliquota_csrf_applied = aliquotas.T
+    valor_iss, valor_inss, valor_irrf, valor_csrf = (aliquotas * valor_total[:, None]).T
+
+    # The justifications follow the same rules as the kernel.
+    # 4.1 ISS Retention
+    iss_conds = [is_simei, lc_301, ~same_city, np.full(len(df_nf), not substituto)]
+    just_iss = np.select(iss_conds, [
+        "ISS não retido (fornecedor SIMEI).",
+        "ISS não retido (serviço código 3.01 da LC 116).",
+        "ISS não retido (devido no município do prestador).",
+        "ISS não retido (unidade não é substituto tributário).",
+    ], default="").tolist()
+    just_iss = [j or f"ISS retido ({a:.2%}) pelo tomador (mesmo município e substituto tributário)."
+                for j, a in zip(just_iss, aliquota_iss)]
+
+    # 4.2 INSS Retention
+    inss_conds = [
+        is_simei & cebas,
+        is_simei,
+        is_optante & anexo_iv & retencao_sim,
+        is_optante,
+    ]
+    just_inss = np.select(inss_conds, [
+        "INSS retido (20%) - Fornecedor SIMEI e tomador com CEBAS.",
+        "INSS não retido (fornecedor SIMEI sem tomador com CEBAS).",
+        "INSS retido (11%) - Optante do Simples, Anexo IV e serviço sujeito à retenção.",
+        "INSS não retido (Optante do Simples fora das regras de retenção).",
+    ], default="INSS não retido (Não Optante do Simples - regra geral).").tolist()
+
+    justificativas = [
+        # 4.3 IRRF (example for 10.09)
+        (iss, inss) + (("IRRF retido (1.5%) para serviços de intermediação (10.09).",) if irrf else ())
+        for iss, inss, irrf in zip(just_iss, just_inss, retem_irrf)
+    ]
+
+    # 5. Assemble final data for MAPA
+    total_retencoes = valor_iss + valor_inss + valor_irrf + valor_csrf
+    mapa_df = pd.DataFrame({
+        'unidade': user_config.nome_unidade,
+        'optante_simples_str': np.where(is_optante, "SIM", "NÃO"),
+        'cod_servico_lc116': lc_code,
+        'desc_lc116': [lc['descricao'] for lc in lc116],
+        'cnae_codigo': [c['codigo'] for c in cnae],
+        'cnae_descricao': [c['descricao'] for c in cnae],
+        'cnae_anexo': anexo,
+        'cnae_art_219': [c['art219'] for c in cnae],
+        'codigo_reinf': [r['codigo'] for r in reinf],
+        'descricao_reinf': [r['descricao'] for r in reinf],
+        'aliquota_iss': aliquota_iss_applied,
+        'valor_iss_retido': valor_iss,
+        'aliquota_inss': aliquota_inss_applied,
+        'valor_inss_retido': valor_inss,
+        'aliquota_irrf': aliquota_irrf_applied,
+        'valor_irrf_retido': valor_irrf,
+        'aliquota_csrf': aliquota_csrf_applied, # Placeholder
+        'valor_csrf_retido': valor_csrf,
         'valor_total_retencoes': total_retencoes,
         'valor_liquido': valor_total - total_retencoes,
-        'observacoes_legais': justificativas
-    }
-    return mapa_data
+        'observacoes_legais': justificativas,
+    }, index=df_nf.index)
+    # The invoice fields come first, as in the MAPA data dict; computed fields win on name clashes.
+    return pd.concat([df_nf.drop(columns=mapa_df.columns, errors='ignore'), mapa_df], axis=1)
+
+def processar_regras_fiscais(dados_nf: Dict, simples_status: SimplesStatus, user_config: UserConfig, rules: Dict,
+                             texto_nota: str) -> Optional[MapaRow]:
+    """
+    Orchestrates the entire fiscal rule processing for a single invoice.
+    Returns the MAPA row ready for the MAPA generator, or None if the invoice should be manual.
+    """
+    simples_df = pd.DataFrame([{
+        'is_optante_simples': simples_status.is_optante_simples,
+        'is_simei': simples_status.is_simei,
+    }])
+    mapa_df = processar_regras_fiscais_batch(pd.DataFrame([dados_nf]), simples_df, user_config, rules, [texto_nota])
+    if mapa_df.empty:
+        return None # Skip MAPA generation
+    return MapaRow.from_record(mapa_df.to_dict('records')[0])
@@ -1,28 +1,154 @@
 # simples_automator.py
-# This file contains the pyautogui logic to query the Simples Nacional website.
-# NOTE: This is highly fragile and depends on screen resolution, browser state, and website layout.
+# This file contains the logic to query the Simples Nacional website: a direct
+# HTTP client and, as a fallback, the pyautogui browser automation.
+# NOTE: The automation is highly fragile and depends on screen resolution, browser state, and website layout.
+import os
+import re
 import time
 import webbrowser
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, List, Dict
+
+import lxml.html
 import pyperclip
 import pyautogui as p
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from assets import asset_path
+from config import (SIMPLES_HTTP_TIMEOUT_SECONDS, SIMPLES_HTTP_MAX_WORKERS, SIMPLES_FORM_MARKER_IMAGE,
+                    SIMPLES_RESULT_MARKER_IMAGE, SIMPLES_MARKER_CONFIDENCE)
 
 # --- Constants for Automation ---
 # It's better to keep these configurable if possible.
 SIMPLES_NACIONAL_URL = "http://www8.receita.fazenda.gov.br/SimplesNacional/Aplicacoes/ATB/ConsultaOptantes.app/ConsultarOpcao.aspx"
 # Coordinates and image references would be needed for a real implementation.
-# For this version, we will simulate the steps with time delays.
+# For this version, the steps are simulated; waits poll the screen/clipboard instead of sleeping.
+
+# Markers present in every valid result page.
+_RESULT_MARKERS = ("Períodos Anteriores", "Situação Atual")
+
+def _is_valid_result(texto: Optional[str]) -> bool:
+    return bool(texto) and any(marker in texto for marker in _RESULT_MARKERS)
+
+# --- HTTP Client ---
+# One pooled keep-alive session for the whole run.
+_SESSION = requests.Session()
+_SESSION.headers.update({"User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64)"})
+# Sized for consultar_simples_batch, so every worker thread reuses a pooled connection.
+# Transient failures of the (idempotent) GET are retried with backoff; the POST is not retried.
+_SESSION.mount("http://", HTTPAdapter(pool_connections=SIMPLES_HTTP_MAX_WORKERS, pool_maxsize=SIMPLES_HTTP_MAX_WORKERS,
+                                      max_retries=Retry(total=3, backoff_factor=0.3, status_forcelist=(429, 500, 502, 503, 504))))
+_SESSION.mount("https://", _SESSION.get_adapter("http://"))
+
+# ASP.NET WebForms state that must be echoed back in the POST.
+_ASPNET_STATE_FIELDS = ("__VIEWSTATE", "__VIEWSTATEGENERATOR", "__EVENTVALIDATION")
+_CNPJ_INPUT_XPATH = "//input[contains(translate(@name, 'CNPJ', 'cnpj'), 'cnpj')]"
+_SUBMIT_XPATH = "//input[@type='submit'] | //button[@type='submit']"
+# Result container; falls back to the whole body if the layout changes.
+_RESULT_XPATH = "//div[contains(translate(@id, 'RESULTADO', 'resultado'), 'result')]"
+
+def _parse_html(resp: requests.Response):
+    """Parses an HTML response, honoring its charset (or detecting it when the header has none)."""
+    tem_charset = 'charset' in resp.headers.get('Content-Type', '').lower()
+    encoding = resp.encoding if tem_charset else resp.apparent_encoding
+    return lxml.html.fromstring(resp.content, parser=lxml.html.HTMLParser(encoding=encoding))
+
+def _page_text(element) -> str:
+    """Text content of an element, one line per text node, like a copy from the browser."""
+    linhas = (re.sub(r'\s+', ' ', texto).strip() for texto in element.itertext())
+    return "\n".join(linha for linha in linhas if linha)
+
+def consultar_simples_via_http(cnpj: str) -> Optional[str]:
+    """
+    Queries the Simples Nacional website directly over HTTP for a given CNPJ.
+
+    Returns the text of the result, or None if the query fails or the site
+    demands a CAPTCHA (the caller may then fall back to the browser automation).
+    """
+    print(f"  [HTTP] Consultando o Simples Nacional para o CNPJ: {cnpj}")
+    try:
+        resp = _SESSION.get(SIMPLES_NACIONAL_URL, timeout=SIMPLES_HTTP_TIMEOUT_SECONDS)
+        resp.raise_for_status()
+        form_page = _parse_html(resp)
+
+        cnpj_inputs = form_page.xpath(_CNPJ_INPUT_XPATH)
+        if not cnpj_inputs:
+            print("  [HTTP ERRO] Campo de CNPJ não encontrado no formulário de consulta.")
+            return None
+
+        payload = {campo: (form_page.xpath(f"//input[@name='{campo}']/@value") or [''])[0]
+                   for campo in _ASPNET_STATE_FIELDS}
+        payload[cnpj_inputs[0].get('name')] = cnpj
+        submit = form_page.xpath(_SUBMIT_XPATH)
+        if submit and submit[0].get('name'):
+            payload[submit[0].get('name')] = submit[0].get('value', '')
+
+        resp = _SESSION.post(resp.url, data=payload, timeout=SIMPLES_HTTP_TIMEOUT_SECONDS)
+        resp.raise_for_status()
+        result_page = _parse_html(resp)
+        container = result_page.xpath(_RESULT_XPATH) or result_page.xpath("//body") or [result_page]
+        resultado_texto = _page_text(container[0])
+    except (requests.RequestException, lxml.etree.ParserError) as e:
+        print(f"  [HTTP ERRO] Falha na consulta do Simples Nacional: {e}")
+        return None
+
+    if not _is_valid_result(resultado_texto):
+        # Typically a CAPTCHA challenge or a layout change.
+        print("  [HTTP AVISO] A resposta não contém um resultado válido (possível CAPTCHA).")
+        return None
+    print("  [HTTP] Consulta realizada com sucesso.")
+    return resultado_texto
+
+def consultar_simples_batch(cnpjs: List[str], max_workers: int = SIMPLES_HTTP_MAX_WORKERS) -> Dict[str, Optional[str]]:
+    """
+    Queries many CNPJs concurrently over HTTP (duplicates are queried once).
+    Returns the result text per CNPJ, None where the query failed.
+    Only the HTTP client is threaded: the browser automation must never run concurrently.
+    """
+    unicos = list(dict.fromkeys(cnpjs))
+    if not unicos:
+        return {}
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(unicos))) as executor:
+        return dict(zip(unicos, executor.map(consultar_simples_via_http, unicos)))
+
+# --- Browser Automation (fallback) ---
+
+def _wait_until(predicate, timeout: float = 10, interval: float = 0.05) -> bool:
+    """Polls `predicate()` every `interval` seconds: True as soon as it holds, False after `timeout`."""
+    deadline = time.monotonic() + timeout
+    while True:
+        if predicate():
+            return True
+        if time.monotonic() >= deadline:
+            return False
+        time.sleep(interval)
+
+def _on_screen(image_name: str) -> bool:
+    """True if the marker screenshot `image_name` is currently visible on screen."""
+    path = asset_path(image_name)
+    if not os.path.exists(path):
+        return False
+    try:
+        try:
+            return p.locateOnScreen(path, confidence=SIMPLES_MARKER_CONFIDENCE) is not None
+        except NotImplementedError: # confidence needs opencv-python
+            return p.locateOnScreen(path) is not None
+    except Exception: # pyautogui >= 0.9.41 raises ImageNotFoundException instead of returning None
+        return False
 
-def _wait_for_page_load(timeout=10):
-    """A simple placeholder to simulate waiting for a page to load."""
-    print(f"  [Automator] Aguardando carregamento da página ({timeout}s)...")
-    time.sleep(timeout)
+def _wait_for_page_load(image_name: str, timeout: float = 10) -> bool:
+    """Waits until the page marker is on screen, for at most `timeout` seconds."""
+    print(f"  [Automator] Aguardando carregamento da página (até {timeout}s)...")
+    return _wait_until(lambda: _on_screen(image_name), timeout)
 
 def abrir_chrome_e_site():
     """Opens Chrome and navigates to the Simples Nacional consultation website."""
     try:
         print("  [Automator] Abrindo o navegador Chrome no site do Simples Nacional...")
         webbrowser.get("chrome").open(SIMPLES_NACIONAL_URL)
-        _wait_for_page_load()
+        _wait_for_page_load(SIMPLES_FORM_MARKER_IMAGE)
         # In a real scenario, you'd maximize the window or set it to a known size.
         # p.hotkey('win', 'up') # Example: Maximize window on Windows
         return True
@@ -43,35 +169,34 @@ def consultar_simples_via_automacao(cnpj: str) -> Optional[str]:
     # followed by p.click().
 
     try:
-        # 1. Focus on the CNPJ input field (simulated by a delay and assuming focus)
+        # 1. Focus on the CNPJ input field (simulated by waiting for the form and assuming focus)
         print("    - Focando no campo CNPJ...")
-        time.sleep(2)
+        _wait_for_page_load(SIMPLES_FORM_MARKER_IMAGE, 2)
 
-        # 2. Paste the CNPJ
+        # 2. Paste the CNPJ (once the clipboard actually holds it)
         pyperclip.copy(cnpj)
+        _wait_until(lambda: pyperclip.paste() == cnpj, 1)
         p.hotkey('ctrl', 'v')
         print(f"    - CNPJ {cnpj} colado.")
-        time.sleep(1)
 
         # 3. Find and click the 'Consultar' button (simulated)
         print("    - Clicando no botão 'Consultar'...")
         # p.click(x=123, y=456) # Replace with actual coordinates or image recognition
-        time.sleep(1)
 
         # 4. Wait for the results page to load
-        _wait_for_page_load(5)
+        _wait_for_page_load(SIMPLES_RESULT_MARKER_IMAGE, 5)
 
-        # 5. Select all text and copy to clipboard
+        # 5. Select all text and copy it, until the clipboard holds a result page
         print("    - Selecionando e copiando todo o texto da página de resultados...")
+        pyperclip.copy('')
         p.hotkey('ctrl', 'a')
-        time.sleep(0.5)
         p.hotkey('ctrl', 'c')
-        time.sleep(0.5)
+        _wait_until(lambda: _is_valid_result(pyperclip.paste()), 1)
 
         # 6. Get the result from the clipboard
         resultado_texto = pyperclip.paste()
 
-        if "Períodos Anteriores" in resultado_texto or "Situação Atual" in resultado_texto:
+        if _is_valid_result(resultado_texto):
             print("  [Automator] Consulta realizada com sucesso.")
             return resultado_texto
         else:
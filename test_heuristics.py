@@ -0,0 +1,56 @@
+# test_heuristics.py
+import unittest
+
+# The module to be tested
+import heuristics
+
+class TestHeuristicExtract(unittest.TestCase):
+
+    def setUp(self):
+        """Set up a typical NFS-e text for each test."""
+        self.texto_nota = (
+            "PREFEITURA MUNICIPAL - NOTA FISCAL DE SERVIÇOS ELETRÔNICA\n"
+            "Número da Nota: 000123  Data e Hora de Emissão: 05/03/2024 10:22:01\n"
+            "PRESTADOR: ACME SERVICOS LTDA  CNPJ: 12.345.678/0001-90\n"
+            "TOMADOR: HOSPITAL TESTE  CNPJ: 98.765.432/0001-10\n"
+            "Item da Lista de Serviços: 1.07 - Suporte técnico em informática\n"
+            "Valor dos Serviços: R$ 1.234,56\n"
+        )
+
+    def test_labelled_fields_are_extracted(self):
+        """Test that labelled date, number, value and LC 116 item are resolved."""
+        dados = heuristics.heuristic_extract(self.texto_nota)
+        self.assertEqual(dados['data_emissao'], '05/03/2024')
+        self.assertEqual(dados['numero_nf'], '000123')
+        self.assertAlmostEqual(dados['valor_total'], 1234.56)
+        self.assertEqual(dados['subitem_lc116'], '1.07')
+
+    def test_labelled_prestador_cnpj_is_resolved(self):
+        """Test that the CNPJ in the prestador block is taken, not the tomador's."""
+        dados = heuristics.heuristic_extract(self.texto_nota)
+        self.assertEqual(dados['cnpj_prestador'], '12345678000190')
+        self.assertEqual(heuristics.extrair_cnpj_prestador(self.texto_nota), '12345678000190')
+
+    def test_cpf_prestador_is_left_to_ai(self):
+        """Test that the tomador's CNPJ is not taken when the prestador only has a CPF."""
+        texto = "Prestador: FULANO CPF 123.456.789-01\nTomador: HOSPITAL X CNPJ 44.555.666/0001-99"
+        self.assertNotIn('cnpj_prestador', heuristics.heuristic_extract(texto))
+        self.assertIsNone(heuristics.extrair_cnpj_prestador(texto))
+
+    def test_full_invoice_number_is_extracted(self):
+        """Test that numbers with a year/series prefix are not cut short."""
+        dados = heuristics.heuristic_extract("Número da NFS-e: 2024/118 - Série A")
+        self.assertEqual(dados['numero_nf'], '2024/118')
+
+    def test_rps_emission_date_is_skipped(self):
+        """Test that the RPS emission date is not taken as the invoice's."""
+        dados = heuristics.heuristic_extract("Data de Emissão do RPS: 01/03/2024\nData de Emissão: 05/03/2024 10:22")
+        self.assertEqual(dados['data_emissao'], '05/03/2024')
+
+    def test_unlabelled_values_are_ignored(self):
+        """Test that dates and amounts without a label are not guessed."""
+        dados = heuristics.heuristic_extract("Vencimento 10/04/2024 - Total R$ 99,90")
+        self.assertEqual(dados, {})
+
+if __name__ == '__main__':
+    unittest.main(argv=['first-arg-is-ignored'], exit=False)
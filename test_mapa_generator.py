@@ -0,0 +1,44 @@
+# test_mapa_generator.py
+import os
+import tempfile
+import unittest
+
+import pymupdf
+
+# The module to be tested
+import mapa_generator
+from models import MapaRow
+
+class TestMapaPdf(unittest.TestCase):
+
+    def setUp(self):
+        """Render a MAPA once per test into a temporary file."""
+        self.mapa = MapaRow(
+            unidade='UNIDADE TESTE', optante_simples_str='SIM', cod_servico_lc116='1.07', desc_lc116='Suporte Técnico',
+            cnae_codigo='6204000', cnae_descricao='Consultoria em TI', cnae_anexo='V', cnae_art_219='',
+            codigo_reinf='15032', descricao_reinf='Serviços de programação',
+            aliquota_iss=0.05, valor_iss_retido=50.0, aliquota_inss=0.0, valor_inss_retido=0.0,
+            aliquota_irrf=0.0, valor_irrf_retido=0.0, aliquota_csrf=0.0, valor_csrf_retido=0.0,
+            valor_total_retencoes=50.0, valor_liquido=950.0, observacoes_legais=('ISS retido (5.00%).',),
+            nome_fornecedor='ACME SERVICOS LTDA', valor_total=1000.0, titulo_mapa='UNIDADE TESTE - ACME SERVICOS LTDA',
+        )
+        fd, self.caminho = tempfile.mkstemp(suffix='.pdf')
+        os.close(fd)
+        self.addCleanup(os.remove, self.caminho)
+        mapa_generator.gerar_mapa_pdf(self.mapa, self.caminho)
+
+    def _span_colors(self):
+        """Maps each text span on the page to its fill colour (0xRRGGBB)."""
+        with pymupdf.open(self.caminho) as doc:
+            blocks = doc[0].get_text('dict')['blocks']
+        return {span['text'].strip(): span['color']
+                for block in blocks for line in block.get('lines', []) for span in line['spans']}
+
+    def test_values_are_drawn_in_black(self):
+        """Test that single-line values are visible (black), not white like the box labels."""
+        cores = self._span_colors()
+        for valor in ('ACME SERVICOS LTDA', 'UNIDADE TESTE', '1.07', 'Consultoria em TI', 'R$ 50,00'):
+            self.assertEqual(cores.get(valor), 0x000000, valor)
+
+if __name__ == '__main__':
+    unittest.main(argv=['first-arg-is-ignored'], exit=False)
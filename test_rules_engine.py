@@ -1,31 +1,41 @@
 # test_rules_engine.py
+import functools
 import unittest
 import pandas as pd
 from unittest.mock import MagicMock
 
 # The module to be tested
 import rules_engine
+from models import UserConfig, SimplesStatus
+
+# Mock rule tables, shared by every test.
+_CNAE_DATA = {
+    'cnae': [6204000, 6201501],
+    'descricao': ['Consultoria em TI', 'Desenvolvimento de software'],
+    'anexo': ['V', 'IV'],
+    'retencao': ['NAO', 'SIM'],
+    'art219': ['', 'Art. 219...']
+}
+_REINF_DATA = {'codigo': [15032], 'descricao': ['Serviços de programação']}
+_LC116_DATA = {"1.07": "Suporte Técnico", "3.01": "Serviço de Cessão de Mão de Obra"}
+
+@functools.cache
+def _build_mock_rules():
+    """Builds the mock rules dict once per test run."""
+    cnae = pd.DataFrame(_CNAE_DATA, copy=False)
+    return {
+        'cnae': cnae,
+        'cnae_soa': rules_engine._build_cnae_soa(cnae),
+        'reinf': pd.DataFrame(_REINF_DATA, copy=False),
+        'lc116': _LC116_DATA
+    }
 
 class TestFiscalRulesEngine(unittest.TestCase):
 
     @classmethod
     def setUpClass(cls):
         """Set up mock data once for all tests."""
-        cnae_data = {
-            'cnae': [6204000, 6201501],
-            'descricao': ['Consultoria em TI', 'Desenvolvimento de software'],
-            'anexo': ['V', 'IV'],
-            'retencao': ['NAO', 'SIM'],
-            'art219': ['', 'Art. 219...']
-        }
-        reinf_data = {'codigo': [15032], 'descricao': ['Serviços de programação']}
-        lc116_data = {"1.07": "Suporte Técnico", "3.01": "Serviço de Cessão de Mão de Obra"}
-
-        cls.mock_rules = {
-            'cnae': pd.DataFrame(cnae_data),
-            'reinf': pd.DataFrame(reinf_data),
-            'lc116': lc116_data
-        }
+        cls.mock_rules = _build_mock_rules()
 
         # This is the default mock state, save it to restore after tests.
         cls.default_cnae_mock = {"codigo": "6204000", "descricao": "Consultoria em TI", "anexo": "V", "retencao": "NAO", "art219": ""}
@@ -44,32 +54,33 @@ class TestFiscalRulesEngine(unittest.TestCase):
             'municipio_prestador': 'SAO PAULO',
             'municipio_tomador': 'SAO PAULO',
         }
-        self.user_config = {
-            'nome_unidade': 'TESTE',
-            'substituto_tributario': True,
-            'possui_cebas': False,
-        }
+        self.user_config = UserConfig(nome_unidade='TESTE', substituto_tributario=True, possui_cebas=False)
         self.texto_nota = "Sample note text"
         # Ensure the mock is reset before each test
         rules_engine.escolher_cnae_com_consenso.return_value = self.default_cnae_mock
+        for mock in (rules_engine.escolher_cnae_com_consenso, rules_engine.escolher_reinf_com_consenso,
+                     rules_engine.buscar_aliquota_iss):
+            mock.reset_mock()
+        rules_engine._CONSENSO_CACHE.clear()
 
     def test_iss_retention_same_city_substituto(self):
         """Test ISS retention when service is in the same city and taker is substituto."""
-        simples = {'is_optante_simples': True, 'is_simei': False}
+        simples = SimplesStatus(is_optante_simples=True, is_simei=False)
         result = rules_engine.processar_regras_fiscais(self.dados_nf, simples, self.user_config, self.mock_rules, self.texto_nota)
-        self.assertAlmostEqual(result['valor_iss_retido'], 50.0) # 1000 * 5%
-        self.assertTrue(any("substituto tributário" in s for s in result['observacoes_legais']))
+        self.assertAlmostEqual(result.valor_iss_retido, 50.0) # 1000 * 5%
+        self.assertTrue(any("substituto tributário" in s for s in result.observacoes_legais))
 
     def test_iss_no_retention_for_simei(self):
         """Test that ISS is not retained for SIMEI providers."""
-        simples = {'is_optante_simples': True, 'is_simei': True}
+        simples = SimplesStatus(is_optante_simples=True, is_simei=True)
         result = rules_engine.processar_regras_fiscais(self.dados_nf, simples, self.user_config, self.mock_rules, self.texto_nota)
-        self.assertEqual(result['valor_iss_retido'], 0)
-        self.assertTrue(any("fornecedor SIMEI" in s for s in result['observacoes_legais']))
+        self.assertEqual(result.valor_iss_retido, 0)
+        self.assertEqual(result.aliquota_iss, 0) # The displayed rate is the one applied
+        self.assertTrue(any("fornecedor SIMEI" in s for s in result.observacoes_legais))
 
     def test_inss_retention_anexo_iv(self):
         """Test INSS retention for Simples Nacional, Anexo IV services."""
-        simples = {'is_optante_simples': True, 'is_simei': False}
+        simples = SimplesStatus(is_optante_simples=True, is_simei=False)
         # Override the mock for this specific test with a COMPLETE dictionary
         rules_engine.escolher_cnae_com_consenso.return_value = {
             "codigo": "6201501",
@@ -79,22 +90,106 @@ class TestFiscalRulesEngine(unittest.TestCase):
             "art219": "Art. 219..."
         }
         result = rules_engine.processar_regras_fiscais(self.dados_nf, simples, self.user_config, self.mock_rules, self.texto_nota)
-        self.assertAlmostEqual(result['valor_inss_retido'], 110.0) # 1000 * 11%
-        self.assertTrue(any("Anexo IV" in s for s in result['observacoes_legais']))
+        self.assertAlmostEqual(result.valor_inss_retido, 110.0) # 1000 * 11%
+        self.assertAlmostEqual(result.aliquota_inss, 0.11)
+        self.assertTrue(any("Anexo IV" in s for s in result.observacoes_legais))
 
     def test_inss_no_retention_outside_anexo_iv(self):
         """Test no INSS retention for Simples Nacional services outside Anexo IV."""
-        simples = {'is_optante_simples': True, 'is_simei': False}
+        simples = SimplesStatus(is_optante_simples=True, is_simei=False)
         result = rules_engine.processar_regras_fiscais(self.dados_nf, simples, self.user_config, self.mock_rules, self.texto_nota)
-        self.assertEqual(result['valor_inss_retido'], 0)
-        self.assertTrue(any("fora das regras" in s for s in result['observacoes_legais']))
+        self.assertEqual(result.valor_inss_retido, 0)
+        self.assertTrue(any("fora das regras" in s for s in result.observacoes_legais))
 
     def test_triage_non_optante_not_exception(self):
         """Test that a non-optante service not in the exception list returns None."""
-        simples = {'is_optante_simples': False, 'is_simei': False}
+        simples = SimplesStatus(is_optante_simples=False, is_simei=False)
         # The default mock for LC 116 is 1.07, which is not in the exception list
         result = rules_engine.processar_regras_fiscais(self.dados_nf, simples, self.user_config, self.mock_rules, self.texto_nota)
         self.assertIsNone(result)
+        # The triage runs before the CNAE/REINF/ISS consensus, which are skipped.
+        rules_engine.escolher_cnae_com_consenso.assert_not_called()
+        rules_engine.escolher_reinf_com_consenso.assert_not_called()
+        rules_engine.buscar_aliquota_iss.assert_not_called()
+
+    def test_batch_computes_each_row(self):
+        """Test the amounts the batch version retains per invoice and that triaged rows are left out."""
+        lc116 = {'Intermediação de negócios': {"codigo": "10.09", "descricao": "Intermediação"}}
+        cnae_iv = {"codigo": "6201501", "descricao": "Desenvolvimento de software", "anexo": "IV", "retencao": "SIM", "art219": "Art. 219..."}
+        rules_engine.escolher_lc116_com_consenso.side_effect = lambda texto, dados_nf, rules: lc116.get(
+            dados_nf['descricao_servico'], {"codigo": "1.07", "descricao": "Suporte Técnico"})
+        rules_engine.escolher_cnae_com_consenso.side_effect = lambda texto, dados_nf, rules: (
+            cnae_iv if dados_nf['descricao_servico'] == 'Desenvolvimento de software' else self.default_cnae_mock)
+        self.addCleanup(setattr, rules_engine.escolher_lc116_com_consenso, 'side_effect', None)
+        self.addCleanup(setattr, rules_engine.escolher_cnae_com_consenso, 'side_effect', None)
+
+        suporte = dict(self.dados_nf, descricao_servico='Suporte técnico')
+        notas = pd.DataFrame([
+            dict(suporte, descricao_servico='Desenvolvimento de software'),                 # Optante, Anexo IV
+            dict(suporte, municipio_tomador='CAMPINAS', valor_total=500.0),                 # SIMEI, other city
+            suporte,                                                                        # Not optante, 1.07
+            dict(suporte, valor_total=None),                                                # No usable total
+            dict(suporte, descricao_servico='Intermediação de negócios', valor_total=2000.0), # Not optante, 10.09
+        ])
+        simples = pd.DataFrame([{'is_optante_simples': True, 'is_simei': False}, {'is_optante_simples': True, 'is_simei': True},
+                                {'is_optante_simples': False, 'is_simei': False}, {'is_optante_simples': True, 'is_simei': False},
+                                {'is_optante_simples': False, 'is_simei': False}])
+        result = rules_engine.processar_regras_fiscais_batch(notas, simples, self.user_config, self.mock_rules, [self.texto_nota] * 5)
+
+        self.assertEqual(result.index.tolist(), [0, 1, 4])
+        colunas = ['valor_iss_retido', 'valor_inss_retido', 'valor_irrf_retido', 'valor_csrf_retido']
+        esperado = [[50.0, 110.0, 0.0, 0.0],  # ISS 5% in the same city; INSS 11% for Anexo IV
+                    [0.0, 0.0, 0.0, 0.0],     # SIMEI: no ISS, and no INSS without CEBAS
+                    [100.0, 0.0, 30.0, 0.0]]  # IRRF 1.5% for 10.09
+        for linha, valores in zip(result[colunas].to_numpy().tolist(), esperado):
+            for valor, valor_esperado in zip(linha, valores):
+                self.assertAlmostEqual(valor, valor_esperado)
+
+    def test_missing_or_invalid_total_goes_to_manual(self):
+        """Test that an invoice without a usable total is triaged out instead of producing NaN amounts."""
+        simples = SimplesStatus(is_optante_simples=True, is_simei=False)
+        for valor in (None, '1.234,56', 0.0):
+            dados_nf = dict(self.dados_nf, valor_total=valor)
+            self.assertIsNone(rules_engine.processar_regras_fiscais(dados_nf, simples, self.user_config, self.mock_rules, self.texto_nota))
+
+    def test_invalid_total_only_drops_its_row(self):
+        """Test that in a batch only the invoice with a malformed total is left out."""
+        notas = pd.DataFrame([self.dados_nf, dict(self.dados_nf, valor_total='1.234,56'), dict(self.dados_nf, valor_total='500.00')])
+        simples = pd.DataFrame([{'is_optante_simples': True, 'is_simei': False}] * 3)
+        result = rules_engine.processar_regras_fiscais_batch(notas, simples, self.user_config, self.mock_rules, [self.texto_nota] * 3)
+        self.assertEqual(result.index.tolist(), [0, 2])
+        self.assertEqual(result['valor_total'].tolist(), [1000.0, 500.0])
+
+    def test_consensus_memoized_per_prestador(self):
+        """Test that invoices of the same prestador and service resolve the CNAE once."""
+        nota = dict(self.dados_nf, cnpj_prestador='12345678000190', descricao_servico='Consultoria em TI')
+        notas = pd.DataFrame([nota, dict(nota, valor_total=500.0), dict(nota, cnpj_prestador='98765432000110')])
+        simples = pd.DataFrame([{'is_optante_simples': True, 'is_simei': False}] * 3)
+        result = rules_engine.processar_regras_fiscais_batch(notas, simples, self.user_config, self.mock_rules, [self.texto_nota] * 3)
+        self.assertEqual(len(result), 3)
+        self.assertEqual(rules_engine.escolher_cnae_com_consenso.call_count, 2)
+
+class TestCnaeMatcher(unittest.TestCase):
+
+    def setUp(self):
+        cnae = pd.DataFrame({'cnae': [6204000, 8121400, 4930202],
+                             'descricao': ['Consultoria em tecnologia da informação', 'Limpeza em prédios e em domicílios',
+                                           'Transporte rodoviário de carga']})
+        self.rules = {'cnae': cnae, 'cnae_desc_list': cnae['descricao'].tolist()}
+
+    def test_service_description_selects_cnae(self):
+        """Test that a wordier service description still matches its CNAE."""
+        descricao = "Serviços de limpeza em prédios e em domicílios referentes a fevereiro/2024"
+        self.assertEqual(rules_engine._buscar_cnae_por_descricao(descricao, self.rules), 8121400)
+
+    def test_unrelated_descriptions_have_no_match(self):
+        """Test that descriptions sharing only stopwords or a single word select nothing (the default CNAE is used)."""
+        for descricao in ("Consultoria contábil e fiscal referente ao mês de março/2024",
+                          "Manutenção de ar condicionado no prédio sede",
+                          "Limpeza de fossas e caixas de gordura",
+                          "Serviços de vigilância patrimonial armada",
+                          "Locação de veículos", None):
+            self.assertIsNone(rules_engine._buscar_cnae_por_descricao(descricao, self.rules), descricao)
 
 if __name__ == '__main__':
     unittest.main(argv=['first-arg-is-ignored'], exit=False)
@@ -1,45 +1,56 @@
 # ui.py
 # This file contains all Tkinter dialogs for user interaction.
+import atexit
 import tkinter as tk
 from tkinter import messagebox, filedialog, simpledialog
-from typing import Optional, Dict, Any
+from typing import Optional
+
+from models import UserConfig
 
 # --- Helper Functions ---
 
-def _setup_tk_root() -> tk.Tk:
-    """Creates a hidden, topmost Tkinter root window."""
-    root = tk.Tk()
-    root.withdraw()
-    root.attributes("-topmost", True)
-    return root
+_root: Optional[tk.Tk] = None
+
+def _destroy_root():
+    try:
+        _root.destroy()
+    except tk.TclError:
+        pass # Already gone
+
+def _get_root() -> tk.Tk:
+    """
+    Returns the hidden, topmost Tkinter root window shared by every dialog.
+    Starting Tk is expensive, so the root is created once and destroyed at exit.
+    Tk is not thread-safe: dialogs must be shown from the main thread.
+    """
+    global _root
+    if _root is None:
+        _root = tk.Tk()
+        _root.withdraw()
+        _root.attributes("-topmost", True)
+        atexit.register(_destroy_root)
+    return _root
 
 # --- Public UI Functions ---
 
 def show_error(title: str, message: str):
     """Displays a modal error message."""
-    root = _setup_tk_root()
-    messagebox.showerror(title, message)
-    root.destroy()
+    messagebox.showerror(title, message, parent=_get_root())
 
 def show_info(title: str, message: str):
     """Displays a modal info message."""
-    root = _setup_tk_root()
-    messagebox.showinfo(title, message)
-    root.destroy()
+    messagebox.showinfo(title, message, parent=_get_root())
 
 def ask_for_folder() -> Optional[str]:
     """Asks the user to select a directory and returns the path."""
-    root = _setup_tk_root()
-    folder_path = filedialog.askdirectory(title="Selecione a pasta contendo os PDFs das notas fiscais")
-    root.destroy()
+    folder_path = filedialog.askdirectory(title="Selecione a pasta contendo os PDFs das notas fiscais", parent=_get_root())
     return folder_path if folder_path else None
 
 def ask_for_file(title: str, prompt: str) -> Optional[str]:
     """Shows a prompt and asks the user to select a single file."""
-    root = _setup_tk_root()
-    messagebox.showinfo(title, prompt)
-    file_path = filedialog.askopenfilename(title=title)
-    root.destroy()
+    root = _get_root()
+    messagebox.showinfo(title, prompt, parent=root)
+    file_path = filedialog.askopenfilename(title=title, parent=root)
     return file_path if file_path else None
 
 class InitialQuestionsDialog(simpledialog.Dialog):
@@ -56,12 +67,14 @@ class InitialQuestionsDialog(simpledialog.Dialog):
         self.vars = {
             'substituto_tributario': tk.BooleanVar(),
             'possui_cebas': tk.BooleanVar(),
-            'preencher_chamado': tk.BooleanVar()
+            'preencher_chamado': tk.BooleanVar(),
+            'use_batch_api': tk.BooleanVar()
         }
 
         tk.Checkbutton(master, text="A unidade é substituto tributário?", variable=self.vars['substituto_tributario']).grid(row=2, sticky="w", padx=5, pady=2)
         tk.Checkbutton(master, text="A unidade possui CEBAS?", variable=self.vars['possui_cebas']).grid(row=3, sticky="w", padx=5, pady=2)
         tk.Checkbutton(master, text="Preencher o 'Chamado' com o número do nome do arquivo?", variable=self.vars['preencher_chamado']).grid(row=4, sticky="w", padx=5, pady=2)
+        tk.Checkbutton(master, text="Usar a Batch API da OpenAI (50% mais barato, pode levar horas)?", variable=self.vars['use_batch_api']).grid(row=5, sticky="w", padx=5, pady=2)
 
         return self.unit_name_entry # initial focus
 
@@ -77,19 +90,18 @@ class InitialQuestionsDialog(simpledialog.Dialog):
             'nome_unidade': self.unit_name_entry.get().strip().upper(),
             'substituto_tributario': self.vars['substituto_tributario'].get(),
             'possui_cebas': self.vars['possui_cebas'].get(),
-            'preencher_chamado': self.vars['preencher_chamado'].get()
+            'preencher_chamado': self.vars['preencher_chamado'].get(),
+            'use_batch_api': self.vars['use_batch_api'].get()
         }
 
-def ask_initial_questions() -> Optional[Dict[str, Any]]:
+def ask_initial_questions() -> Optional[UserConfig]:
     """Displays the initial questions dialog and returns the user's configuration."""
-    root = _setup_tk_root()
-    dialog = InitialQuestionsDialog(root, "Configurações Iniciais do Processamento")
-    root.destroy()
-    return dialog.result if dialog.result else None
+    dialog = InitialQuestionsDialog(_get_root(), "Configurações Iniciais do Processamento")
+    return UserConfig(**dialog.result) if dialog.result else None
 
 def ask_cnpj_confirmation(suggested_cnpj: str) -> Optional[str]:
     """Asks the user to confirm a CNPJ, with fallbacks."""
-    root = _setup_tk_root()
+    root = _get_root()
 
     is_correct = messagebox.askyesno(
         "Confirmar CNPJ do Tomador",
@@ -98,7 +110,6 @@ def ask_cnpj_confirmation(suggested_cnpj: str) -> Optional[str]:
     )
 
     if is_correct:
-        root.destroy()
         return suggested_cnpj
 
     # If not correct, allow manual input
@@ -108,5 +119,4 @@ def ask_cnpj_confirmation(suggested_cnpj: str) -> Optional[str]:
         parent=root
     )
 
-    root.destroy()
     return manual_cnpj.strip() if manual_cnpj else None
@@ -1,5 +1,7 @@
 # utils.py
 # This file will contain miscellaneous utility functions.
+import unicodedata
+from typing import Optional
 
 def normalize_text(text):
     """
@@ -7,4 +9,14 @@ def normalize_text(text):
     """
     return " ".join(text.strip().split())
 
+def normalize_city(city: Optional[str]) -> Optional[str]:
+    """
+    Normalizes a municipality name for comparison: no accents, upper case, single spaces.
+    "São  Paulo " -> "SAO PAULO". Returns None for a missing or blank name.
+    """
+    if not isinstance(city, str):
+        return None
+    ascii_city = unicodedata.normalize('NFKD', city).encode('ascii', 'ignore').decode('ascii')
+    return normalize_text(ascii_city).upper() or None
+
 # More utility functions will be added as needed.